@@ -0,0 +1,178 @@
+#! /usr/bin/env python3
+""" Pandoc filter used by convert.py when CONVERT_MODE=ast.  In that mode,
+the whole page goes through a single pandoc run, and this filter does in the
+document tree what the placeholder passes otherwise do on the RST text:
+
+ * XXXREPLACE placeholders are replaced with the fragments that convert.py
+   has prepared in the JSON file named by CONVERT_FRAGMENTS: either RST
+   text (code) or a list of blocks (HTML, converted by pandoc beforehand);
+ * the blocks between XXXBEGIN-<lang>XXX and XXXENDXXX markers are moved
+   into a container, which convert.py turns into an `.. only::` directive;
+ * links and images are rewritten by filter.py. """
+
+import os
+import re
+import sys
+import json
+
+from pandocfilters import walk, Str, RawInline, RawBlock, Div
+
+from filter import convert_links
+
+PLACEHOLDER_RE = re.compile(r"XXXREPLACE-([0-9a-f]+)XXX")
+BEGIN_RE = re.compile(r"^XXXBEGIN-(\w+)XXX$")
+END = "XXXENDXXX"
+
+BLOCKS = {"Plain", "Para", "LineBlock", "CodeBlock", "RawBlock", "BlockQuote",
+          "OrderedList", "BulletList", "DefinitionList", "Header",
+          "HorizontalRule", "Table", "Figure", "Div", "Null"}
+
+fragments = {}
+
+
+def is_block_fragment(h):
+    fragment = fragments.get(h)
+    return fragment is not None and ("blocks" in fragment or "\n" in fragment["rst"])
+
+
+def fragment_blocks(h):
+    fragment = fragments[h]
+    if "blocks" in fragment:
+        return fragment["blocks"]
+    return [RawBlock("rst", fragment["rst"].strip("\n"))]
+
+
+def transform_inlines(inlines, top=False):
+    """ Replaces the placeholders for inline fragments.  Placeholders for
+    block fragments are split off into their own Str, so that the paragraph
+    can be split there, if it is directly in a paragraph (top), and are
+    inserted as raw RST otherwise. """
+
+    result = []
+    for inline in inlines:
+        if inline.get("t") != "Str" or "XXXREPLACE-" not in inline["c"]:
+            result.append(transform(inline))
+            continue
+
+        parts = PLACEHOLDER_RE.split(inline["c"])
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                if part:
+                    result.append(Str(part))
+            elif part not in fragments:
+                result.append(Str("XXXREPLACE-" + part + "XXX"))
+            elif top and is_block_fragment(part):
+                result.append(Str("XXXREPLACE-" + part + "XXX"))
+            else:
+                result.append(RawInline("rst", fragments[part].get("rst", "")))
+                # Inline markup must be followed by a space or punctuation.
+                if i + 1 < len(parts) and re.match(r"\w", parts[i + 1]):
+                    result.append({"t": "Space"})
+
+    return result
+
+
+def split_paragraph(block):
+    """ Returns a list of blocks in which the paragraph is split around the
+    block fragments it contains. """
+
+    inlines = transform_inlines(block["c"], top=True)
+    result = []
+    current = []
+
+    def flush():
+        while current and current[0]["t"] in ("Space", "SoftBreak", "LineBreak"):
+            current.pop(0)
+        while current and current[-1]["t"] in ("Space", "SoftBreak", "LineBreak"):
+            current.pop()
+        if current:
+            result.append({"t": block["t"], "c": list(current)})
+        del current[:]
+
+    for inline in inlines:
+        match = PLACEHOLDER_RE.match(inline["c"]) if inline["t"] == "Str" else None
+        if match and is_block_fragment(match.group(1)):
+            flush()
+            result.extend(fragment_blocks(match.group(1)))
+        else:
+            current.append(inline)
+
+    flush()
+    return result
+
+
+def marker(block):
+    """ Returns the language of a begin marker, END for an end marker, or
+    None if the block is not a marker. """
+
+    if block["t"] not in ("Para", "Plain") or len(block["c"]) != 1:
+        return None
+    inline = block["c"][0]
+    if inline["t"] != "Str":
+        return None
+    if inline["c"] == END:
+        return END
+    match = BEGIN_RE.match(inline["c"])
+    return match.group(1) if match else None
+
+
+def transform_blocks(blocks):
+    expanded = []
+    for block in blocks:
+        if block["t"] in ("Para", "Plain"):
+            expanded.extend(split_paragraph(block))
+        else:
+            expanded.append(transform(block))
+
+    # Group the language blocks, which may be nested.
+    stack = [(None, [])]
+    for block in expanded:
+        lang = marker(block)
+        if lang is None:
+            stack[-1][1].append(block)
+        elif lang != END:
+            stack.append((lang, []))
+        elif len(stack) > 1:
+            lang, content = stack.pop()
+            stack[-1][1].append(Div(["", ["only-" + lang], []], content))
+
+    while len(stack) > 1:
+        lang, content = stack.pop()
+        stack[-1][1].append(Div(["", ["only-" + lang], []], content))
+
+    return stack[0][1]
+
+
+def transform(x):
+    """ Expands the fragments and markers anywhere in the given element. """
+
+    if isinstance(x, list):
+        if x and all(isinstance(item, dict) and "t" in item for item in x):
+            if x[0]["t"] in BLOCKS:
+                return transform_blocks(x)
+            return transform_inlines(x)
+        return [transform(item) for item in x]
+
+    if isinstance(x, dict) and "c" in x:
+        x = dict(x)
+        x["c"] = transform(x["c"])
+
+    return x
+
+
+if __name__ == '__main__':
+    with open(os.environ["CONVERT_FRAGMENTS"], "r", encoding="utf-8") as f:
+        fragments.update(json.load(f))
+
+    doc = json.loads(sys.stdin.read())
+    format = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    if isinstance(doc, dict):
+        meta = doc.get("meta", {})
+        doc["blocks"] = walk(transform(doc["blocks"]), convert_links, format, meta)
+    else:
+        # Before pandoc 1.18
+        meta = doc[0]["unMeta"]
+        doc[1] = walk(transform(doc[1]), convert_links, format, meta)
+
+    json.dump(doc, sys.stdout)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+""" Builds the HTML manual with one sphinx-build process per language
+variation, each running with parallel read/write.  This is an alternative
+to "make html", which lets the variations extension build both languages
+one after the other in a single process.
+
+Every variation keeps its own doctree cache in build/doctrees/<variation>,
+so an edit to one page only rereads that page in each variation.  The
+`.. only::` blocks are resolved at write time, so on a cold build the
+environment that was pickled for the first variation is copied over to
+seed the others, which then only need to write their output.
+
+With --split-sources, each variation is built from its own source tree, as
+written by splitlang.py, in which the `.. only::` blocks have already been
+resolved.  These builds have separate doctree caches, which are not seeded
+from each other, since their sources differ. """
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+
+# These must match the variations in source/conf.py.
+VARIATIONS = ['python', 'cpp']
+
+SOURCE_DIR = 'source'
+BUILD_DIR = 'build'
+
+
+# Set by --split-sources.
+split_sources = False
+
+
+def source_dir(variation):
+    if split_sources:
+        return '{}-{}'.format(SOURCE_DIR, variation)
+    return SOURCE_DIR
+
+
+def doctree_dir(variation):
+    if split_sources:
+        return os.path.join(BUILD_DIR, 'doctrees', variation + '-split')
+    return os.path.join(BUILD_DIR, 'doctrees', variation)
+
+
+def has_environment(variation):
+    return os.path.isfile(os.path.join(doctree_dir(variation), 'environment.pickle'))
+
+
+def start_build(variation, jobs, sphinx_opts):
+    """ Starts sphinx-build for the given variation and returns the process
+    handle. """
+
+    cmd = [os.environ.get('SPHINXBUILD', 'sphinx-build'),
+           '-b', 'html',
+           '-j', jobs,
+           '-d', doctree_dir(variation),
+           '-t', variation]
+    cmd += sphinx_opts
+    outdir = os.path.join(BUILD_DIR, 'html', variation)
+    cmd += [source_dir(variation), outdir]
+
+    env = dict(os.environ)
+    env['PANDA3D_VARIATION'] = variation
+
+    # When linking to a separately built reference, point the links to it
+    # from where this variation ends up.
+    if env.get('PANDA3D_REFERENCE') and not env.get('PANDA3D_REFERENCE_URL'):
+        env['PANDA3D_REFERENCE_URL'] = os.path.relpath(env['PANDA3D_REFERENCE'], outdir)
+
+    print("Building {} variation: {}".format(variation, ' '.join(cmd)))
+    return subprocess.Popen(cmd, env=env)
+
+
+def build(variations, jobs, sphinx_opts):
+    """ Builds the given variations, returning the number that failed. """
+
+    timings = {}
+    failures = 0
+
+    # If no variation has a cached environment yet, build the first one on
+    # its own, so that the others can reuse what it has read.
+    if not split_sources and not any(has_environment(v) for v in variations):
+        first = variations[0]
+        start = time.time()
+        if start_build(first, jobs, sphinx_opts).wait() != 0:
+            return 1
+
+        timings[first] = time.time() - start
+        variations = variations[1:]
+
+    seed = None
+    if not split_sources:
+        seed = next((v for v in VARIATIONS if has_environment(v)), None)
+
+    # Seed all the caches before starting, since the seed may be rebuilding.
+    for variation in variations:
+        if seed and not has_environment(variation):
+            print("Seeding {} doctrees from {}".format(variation, seed))
+            if os.path.isdir(doctree_dir(variation)):
+                shutil.rmtree(doctree_dir(variation))
+            shutil.copytree(doctree_dir(seed), doctree_dir(variation))
+
+    procs = []
+    for variation in variations:
+        procs.append((variation, time.time(), start_build(variation, jobs, sphinx_opts)))
+
+    for variation, start, proc in procs:
+        if proc.wait() != 0:
+            print("Build of {} variation failed".format(variation))
+            failures += 1
+        timings[variation] = time.time() - start
+
+    print()
+    for variation, duration in timings.items():
+        print("{:>8.2f} s  {}".format(duration, variation))
+
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Builds the HTML manual for each language variation in parallel.")
+    parser.add_argument('-j', '--jobs', default='auto',
+                        help="number of parallel jobs per sphinx-build (default: auto)")
+    parser.add_argument('-v', '--variation', action='append', dest='variations', choices=VARIATIONS,
+                        help="only build the given variation (may be repeated)")
+
+    parser.add_argument('--split-sources', action='store_true',
+                        help="build each variation from its own source tree, as written by splitlang.py")
+
+    # Any other options are passed on to sphinx-build.
+    args, sphinx_opts = parser.parse_known_args()
+    split_sources = args.split_sources
+
+    failures = build(args.variations or VARIATIONS, args.jobs, sphinx_opts)
+    if failures:
+        sys.exit(1)
+
+    print("Build finished. The HTML pages are in {}/html/<variation>.".format(BUILD_DIR))
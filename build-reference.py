@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+""" Builds the API reference as a Sphinx project of its own, in reference/,
+with its own doctree cache, so that building the manual does not need to
+read, pickle and resolve the thousands of reference pages every time.
+
+The reference pages are regenerated with generate-apidoc.py, which skips
+the libraries whose interrogate data did not change.  sphinx-build is then
+only run if any file in reference/ is newer than the last build's
+objects.inv, which the manual uses to link to the reference through
+intersphinx; see "make html-manual". """
+
+import os
+import sys
+import argparse
+import subprocess
+
+SOURCE_DIR = 'reference'
+BUILD_DIR = os.path.join('build', 'reference')
+OUTPUT_DIR = os.path.join(BUILD_DIR, 'html')
+INVENTORY = os.path.join(OUTPUT_DIR, 'objects.inv')
+
+
+def newest_source():
+    """ Returns the modification time of the most recently changed file in
+    the reference project. """
+
+    newest = 0
+    for dirpath, dirnames, filenames in os.walk(SOURCE_DIR):
+        for fn in filenames:
+            newest = max(newest, os.path.getmtime(os.path.join(dirpath, fn)))
+    return newest
+
+
+def is_up_to_date():
+    return os.path.isfile(INVENTORY) and os.path.getmtime(INVENTORY) >= newest_source()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Builds the API reference as a separate Sphinx project.")
+    parser.add_argument('--no-generate', action='store_true',
+                        help="don't run generate-apidoc.py first, e.g. if panda3d is not installed here")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="run sphinx-build even if nothing changed")
+    parser.add_argument('-j', '--jobs', default='auto',
+                        help="number of parallel jobs for sphinx-build (default: auto)")
+
+    # Any other options are passed on to sphinx-build.
+    args, sphinx_opts = parser.parse_known_args()
+
+    if not args.no_generate:
+        subprocess.check_call([sys.executable, 'generate-apidoc.py', '--source-dir', SOURCE_DIR])
+
+    if not args.force and is_up_to_date():
+        print("The reference in {} is up to date.".format(OUTPUT_DIR))
+        sys.exit(0)
+
+    cmd = [os.environ.get('SPHINXBUILD', 'sphinx-build'),
+           '-b', 'html',
+           '-j', args.jobs,
+           '-d', os.path.join(BUILD_DIR, 'doctrees')]
+    cmd += sphinx_opts
+    cmd += [SOURCE_DIR, OUTPUT_DIR]
+
+    print(' '.join(cmd))
+    if subprocess.call(cmd) != 0:
+        sys.exit(1)
+
+    # Sphinx leaves objects.inv alone if it did not change.
+    os.utime(INVENTORY)
+
+    print("Build finished. The reference is in {}.".format(OUTPUT_DIR))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+""" Checks the converted manual for broken links without running Sphinx.
+
+Scans all .rst files under source/ (including the generated reference) and
+reports every :ref: whose label is not defined by a `.. _name:` anchor,
+every image that does not exist on disk and every toctree entry that does
+not point to an existing document.  Exits with a non-zero status if any
+problem was found, so it can be used as an early CI step. """
+
+import os
+import re
+import sys
+import argparse
+
+LABEL_RE = re.compile(r'^\s*\.\. _([^:`]+):\s*$')
+REF_RE = re.compile(r':ref:`([^`]+)`')
+IMAGE_RE = re.compile(r'^\s*\.\. (?:\|[^|]+\| )?(?:image|figure)::\s*(\S+)')
+TOCTREE_RE = re.compile(r'^(\s*)\.\. toctree::')
+
+
+def find_documents(source_dir):
+    """ Yields the path of every .rst file, relative to the source dir and
+    without suffix, in the form that Sphinx uses as document name. """
+
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames[:] = [d for d in dirnames if not d.startswith(('.', '_'))]
+        for fn in filenames:
+            if fn.endswith('.rst'):
+                path = os.path.relpath(os.path.join(dirpath, fn), source_dir)
+                yield path[:-4].replace(os.sep, '/')
+
+
+def resolve_docname(docname, entry):
+    """ Resolves a toctree entry relative to the document containing it. """
+
+    if entry.startswith('/'):
+        return entry[1:]
+
+    parts = docname.split('/')[:-1] + entry.split('/')
+    resolved = []
+    for part in parts:
+        if part == '..':
+            if resolved:
+                resolved.pop()
+        elif part and part != '.':
+            resolved.append(part)
+    return '/'.join(resolved)
+
+
+def scan(source_dir):
+    """ Reads all documents, returning the set of labels, the set of document
+    names, and a list of (docname, lineno, kind, target) for all links. """
+
+    labels = set()
+    docnames = set()
+    links = []
+
+    for docname in find_documents(source_dir):
+        docnames.add(docname)
+
+        with open(os.path.join(source_dir, docname + '.rst'), 'r', encoding='utf-8') as f:
+            text = f.read()
+        lines = text.splitlines()
+
+        # References may be wrapped over several lines by pandoc.
+        for match in REF_RE.finditer(text):
+            label = match.group(1)
+            if label.endswith('>') and '<' in label:
+                label = label.rsplit('<', 1)[1][:-1]
+            lineno = text.count('\n', 0, match.start()) + 1
+            links.append((docname, lineno, 'ref', ' '.join(label.split()).lower()))
+
+        toctree_indent = None
+        for lineno, line in enumerate(lines, 1):
+            match = LABEL_RE.match(line)
+            if match:
+                labels.add(match.group(1).strip().lower())
+                continue
+
+            # Toctree entries are the indented lines that are not options.
+            if toctree_indent is not None:
+                stripped = line.strip()
+                indent = len(line) - len(line.lstrip())
+                if stripped and indent <= toctree_indent:
+                    toctree_indent = None
+                elif stripped and not stripped.startswith(':'):
+                    entry = stripped
+                    if entry.endswith('>') and '<' in entry:
+                        entry = entry.rsplit('<', 1)[1][:-1]
+                    links.append((docname, lineno, 'doc', entry))
+                    continue
+                else:
+                    continue
+
+            match = TOCTREE_RE.match(line)
+            if match:
+                toctree_indent = len(match.group(1))
+                continue
+
+            match = IMAGE_RE.match(line)
+            if match:
+                links.append((docname, lineno, 'image', match.group(1)))
+
+    return labels, docnames, links
+
+
+def check(source_dir):
+    """ Returns the number of links checked and a list of (docname, lineno,
+    message) for every broken link. """
+
+    labels, docnames, links = scan(source_dir)
+    problems = []
+
+    for docname, lineno, kind, target in links:
+        if kind == 'ref':
+            if target not in labels:
+                problems.append((docname, lineno, "undefined label '{}'".format(target)))
+
+        elif kind == 'image':
+            if '://' in target:
+                continue
+            if target.startswith('/'):
+                path = os.path.join(source_dir, target[1:])
+            else:
+                path = os.path.join(source_dir, os.path.dirname(docname), target)
+            if not os.path.isfile(path):
+                problems.append((docname, lineno, "missing image '{}'".format(target)))
+
+        elif kind == 'doc':
+            if '://' in target or target == 'self':
+                continue
+            if resolve_docname(docname, target) not in docnames:
+                problems.append((docname, lineno, "toctree entry '{}' does not exist".format(target)))
+
+    return len(links), problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks labels, images and toctree entries in the converted manual.")
+    parser.add_argument('source_dir', nargs='?', default='source',
+                        help="directory containing the .rst files (default: source)")
+    args = parser.parse_args()
+
+    num_links, problems = check(args.source_dir)
+
+    for docname, lineno, message in problems:
+        print("{}/{}.rst:{}: {}".format(args.source_dir, docname, lineno, message))
+
+    print("Checked {} links, {} broken.".format(num_links, len(problems)))
+    if problems:
+        sys.exit(1)
@@ -1,7 +1,21 @@
+import io
 import re
+import sys
+import time
+import bz2
+import gzip
 import json
+import lzma
+import subprocess
 from collections import defaultdict
 
+# The scripts that the conversion of a page depends on.
+CONVERTER_SCRIPTS = ['convert.py', 'filter.py', 'astfilter.py', 'common.py']
+
+# The files that the output of a page depends on, which are also the ones
+# that foo.py writes before converting: the toctree and the redirects.
+CONVERTER_DEPENDENCIES = CONVERTER_SCRIPTS + ['toctree.json', 'redirects.json']
+
 # Some page name substitutions.  Ones that are None or not in the dict
 # will be automatically converted by transform_title().
 page_map = {
@@ -403,6 +417,13 @@ page_map = {
     "Third-party dependencies and license info": "thirdparty-licenses",
 }
 
+# Magic bytes of the compression formats accepted by open_dump().
+dump_decompressors = [
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+]
+
 page_parents = {"Main Page": None}
 page_children = defaultdict(list)
 
@@ -493,3 +514,92 @@ def get_page_children(title, noindex=False):
         child_paths.append(transformed)
 
     return child_paths
+
+
+def read_magic(f, size=6):
+    """ Reads the first bytes of the stream, which a pipe may hand out in
+    more than one piece.  Returns fewer bytes only at the end of the
+    stream. """
+
+    magic = b''
+    while len(magic) < size:
+        data = f.read(size - len(magic))
+        if not data:
+            break
+        magic += data
+    return magic
+
+
+class ReplayStream(io.RawIOBase):
+    """ Returns the given bytes, which were already read from the stream,
+    and then the rest of the stream, which is not closed with this one. """
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.prefix:
+            n = min(len(b), len(self.prefix))
+            b[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        return self.stream.readinto(b)
+
+
+def open_dump(fn):
+    """ Opens the MediaWiki XML dump for reading as a binary stream, which
+    may be gzip, bzip2 or xz compressed, in which case it is decompressed
+    while it is being read.  Pass - to read from stdin. """
+
+    # Detect the format from the contents rather than the extension, so that
+    # it also works for stdin.
+    if fn == '-':
+        magic = read_magic(sys.stdin.buffer)
+        f = io.BufferedReader(ReplayStream(magic, sys.stdin.buffer))
+    else:
+        with open(fn, 'rb') as f:
+            magic = read_magic(f)
+        f = None
+
+    for prefix, decompressor in dump_decompressors:
+        if magic.startswith(prefix):
+            # Let the decompressor open the file itself, so that closing it
+            # closes the file as well.
+            return decompressor(f or fn, 'rb')
+
+    return f or open(fn, 'rb')
+
+
+def convert_page(title, text, output, children):
+    """ Converts the text of a single page with convert.py, writing it with
+    an anchor and a toctree of the given children to output.  Returns
+    whether it failed and how many seconds it took. """
+
+    start = time.perf_counter()
+    with open(output, "wb") as f:
+        # Write an anchor so we can refer to this page.
+        f.write(".. _{}:\n\n".format(transform_title(title)).encode('utf-8'))
+        f.flush()
+
+        handle = subprocess.Popen(["./convert.py", "-"], stdin=subprocess.PIPE, stdout=f)
+
+        # Prepend a first-level header containing the page title.
+        data = "= {} =\n". format(title.replace('CXX', 'C++')).encode("utf-8")
+        data += text.encode("utf-8")
+        handle.communicate(data)
+
+        # If this page has children, write out a toc tree at the bottom.
+        if children:
+            f.write(b'\n\n.. toctree::\n')
+            f.write(b'   :maxdepth: 2\n')
+            f.write(b'\n')
+
+        for child in children:
+            f.write(b'   ' + (child.encode('utf-8')))
+            f.write(b'\n')
+
+    return handle.returncode != 0, time.perf_counter() - start
@@ -2,6 +2,8 @@
 
 import os, sys
 import re
+import json
+import asyncio
 import tempfile
 import subprocess
 from bs4 import BeautifulSoup
@@ -9,7 +11,7 @@ from bs4.element import *
 from hashlib import sha1
 from toolz import curry
 
-from common import transform_title
+from common import transform_title, CONVERTER_DEPENDENCIES
 
 KEEP=["b", "i", "u", "strong", "em", "blockquote", "sub", "sup"]
 CODE=["code", "pre", "syntaxhighlight"]
@@ -28,6 +30,94 @@ CONTENTS = dict()
 # set to '--columns=72' to allow wrapping
 NOWRAP = '--columns=78' #'--no-wrap'
 
+# Directory in which converted HTML and LangSwitch fragments are cached across
+# pages and runs.  Set CONVERT_CACHE to an empty string to disable it, and
+# remove the directory after upgrading pandoc.
+FRAGMENT_CACHE = os.environ.get('CONVERT_CACHE', 'fragment-cache')
+
+# Set to 'ast' to convert every page with a single pandoc run, in which
+# astfilter.py expands the fragments, instead of a pandoc run per fragment.
+CONVERT_MODE = os.environ.get('CONVERT_MODE', 'passes')
+
+_cache_salt = None
+
+def fragment_cache_path(mode, digest, ext=".rst"):
+    """ Returns the path at which the output of the given converter for the
+    fragment with the given hash is cached, or None if caching is off. """
+
+    global _cache_salt
+    if not FRAGMENT_CACHE or not digest:
+        return None
+
+    if _cache_salt is None:
+        h = sha1(NOWRAP.encode("utf-8"))
+        for fn in CONVERTER_DEPENDENCIES:
+            if os.path.isfile(fn):
+                with open(fn, "rb") as f:
+                    h.update(f.read())
+        _cache_salt = h.hexdigest()
+
+        if not os.path.isdir(FRAGMENT_CACHE):
+            os.makedirs(FRAGMENT_CACHE, exist_ok=True)
+
+    key = sha1((_cache_salt + digest).encode("ascii")).hexdigest()
+    return os.path.join(FRAGMENT_CACHE, "{}-{}{}".format(mode, key, ext))
+
+def write_cache(path, text):
+    # Other conversions may be running at the same time.
+    fd, tmp = tempfile.mkstemp(dir=FRAGMENT_CACHE)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def cached(render):
+    """ Decorator for Converter.render() that stores the result in the
+    fragment cache, so that the same fragment is only converted once. """
+
+    async def wrapper(self):
+        if self.result is not None or self.load_cached():
+            return
+
+        await render(self)
+
+        path = fragment_cache_path(type(self).__name__, self.digest)
+        if path:
+            write_cache(path, self.result)
+
+    return wrapper
+
+
+# Maximum number of pandoc processes running at the same time, and the
+# number of seconds after which a single pandoc call is aborted.
+PANDOC_JOBS = int(os.environ.get('PANDOC_JOBS', os.cpu_count() or 4))
+PANDOC_TIMEOUT = int(os.environ.get('PANDOC_TIMEOUT', 300))
+
+_pandoc_slots = None
+
+async def pandoc(args, data):
+    """ Runs pandoc with the given arguments on the given text, writing the
+    input and reading the output at the same time. """
+
+    global _pandoc_slots
+    if _pandoc_slots is None:
+        _pandoc_slots = asyncio.Semaphore(PANDOC_JOBS)
+
+    async with _pandoc_slots:
+        proc = await asyncio.create_subprocess_exec("pandoc", *args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            out, _ = await asyncio.wait_for(proc.communicate(data), PANDOC_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise RuntimeError("pandoc {} timed out after {} seconds".format(" ".join(args), PANDOC_TIMEOUT))
+
+    if proc.returncode != 0:
+        raise RuntimeError("pandoc {} exited with status {}".format(" ".join(args), proc.returncode))
+
+    return out.decode("utf-8")
+
 def replacer(char_follows):
 
     def matcher(match):
@@ -41,40 +131,114 @@ def replacer(char_follows):
 
 
 
+def serialize(elem):
+    """ Returns the hash and the UTF-8 encoded HTML of the element. """
+
+    payload = str(elem).encode("utf-8")
+    return sha1(payload).hexdigest(), payload
+
+
 class Converter(object):
-    def __init__(self, elem):
-        self.elem = elem
+    def __init__(self, elem, digest=None, payload=None):
+        self.digest = digest
+        self.payload = payload
+        self.result = None
+        self.task = None
+        self.prepare(elem)
+
+    def prepare(self, elem):
+        """ Takes what the conversion needs from the element, which is not
+        kept, so that the parsed page can be freed before the fragments are
+        rendered. """
+        pass
+
+    async def render(self):
+        """ Does the conversion work that output() depends on, such as
+        running pandoc.  All fragments of a page are rendered concurrently,
+        before the placeholders are replaced. """
+        pass
+
+    def load_cached(self):
+        """ Sets the result from the fragment cache.  Returns False if it is
+        not in the cache. """
+
+        path = fragment_cache_path(type(self).__name__, self.digest)
+        if not path or not os.path.isfile(path):
+            return False
+
+        with open(path, "r", encoding="utf-8") as f:
+            self.result = f.read()
+        return True
+
+    def rendered(self):
+        """ Returns the task that renders this fragment.  A fragment that
+        occurs in several places, such as in both language blocks, is shared
+        between them, and each of them waits for the same task. """
+
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.render())
+        return self.task
 
     def output(self):
         raise NotImplementedError
 
 class HTML(Converter):
+    def prepare(self, elem):
+        if self.payload is None:
+            self.digest, self.payload = serialize(elem)
+
+    @cached
+    async def render(self):
+        self.result = await pandoc(['-fhtml', '-trst', '-F./filter.py', NOWRAP], self.payload)
+
     def output(self):
-        self.pipe = subprocess.Popen(['pandoc', '-fhtml', '-trst', '-F./filter.py', NOWRAP], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        #print(self.elem.prettify(encoding="ascii", formatter="minimal").decode("ascii"))
-        res = self.pipe.communicate(str(self.elem).encode("utf-8"))[0].decode("utf-8")
-        return res
+        return self.result
     
         
 class LangSwitch(Converter):
-    def output(self):
-        pipe = Pandoc().convert(self.elem)
-
-        lang = self.elem.name
-        if lang == 'cxx':
-            lang = 'cpp'
-
+    def prepare(self, elem):
+        self.lang = elem.name
+        if self.lang == 'cxx':
+            self.lang = 'cpp'
+
+        # A cached block doesn't need any of its fragments, so none are
+        # created, and no other scope waits for a fragment that is never
+        # rendered.
+        self.simple = None
+        self.pandoc = None
+        if self.load_cached():
+            return
+
+        # Most language blocks are just a code snippet, which doesn't need
+        # another pandoc process.
+        self.simple = render_simple(elem)
+        if self.simple is None:
+            self.pandoc = Pandoc()
+            self.pandoc.collect(elem)
+
+    @cached
+    async def render(self):
         res = ["""
 
 .. only:: {}
 
-""".format(lang)]
+""".format(self.lang)]
+
+        if self.simple is not None:
+            res.extend('    ' + tl for tl in self.simple.splitlines(True))
+            self.result = "".join(res)
+            return
+
+        converted = await self.pandoc.run()
 
-        for line in pipe.stdout:
-            translated_line = replace_placeholders(line.decode("utf-8"))
+        for line in converted.splitlines(True):
+            translated_line = replace_placeholders(line)
             res.extend('    ' + tl for tl in translated_line.splitlines(True))
 
-        return "".join(res)    
+        self.result = "".join(res)
+
+    def output(self):
+        return self.result
 
 
 
@@ -103,41 +267,127 @@ class Code(Converter):
         except KeyError:
             return lang
     
-    def output(self):
+    def prepare(self, elem):
         r = []
-        if len(list(self.elem.descendants))>1:
-            raise RuntimeError("invalid code object "+str(self.elem))
-        if self.elem.attrs and self.elem.name != "pre":
-            lang = str(list(self.elem.attrs.keys())[0])
-            if self.elem.has_attr("lang"):
-                lang = self.elem["lang"]
-            assert lang != "lang", "invalid lang for elem"+str(self.elem)
+        if len(list(elem.descendants))>1:
+            raise RuntimeError("invalid code object "+str(elem))
+        if elem.attrs and elem.name != "pre":
+            lang = str(list(elem.attrs.keys())[0])
+            if elem.has_attr("lang"):
+                lang = elem["lang"]
+            assert lang != "lang", "invalid lang for elem"+str(elem)
             r.append("\n\n.. code-block:: " + self.convert_langtag(lang) + "\n")
-            code = str(self.elem.string)
+            code = str(elem.string)
             if not code.startswith("\n"):
                 r.append("\n")
             r.append(self.dump(code))
             r.append("\n")
         else:
-            t = str(self.elem.string)
+            t = str(elem.string)
             if "\n" not in t:
                 r.append(u'``' + t + '``')
             else:
                 r.append(u"::\n")
                 r.append(self.dump(t))
                 r.append("\n")
-        return "".join(r)
+        self.result = "".join(r)
+
+    def output(self):
+        return self.result
+
+
+# Inline tags that render_simple() can handle, with their RST markup.
+SIMPLE_KEEP = {"b": "**", "strong": "**", "i": "*", "em": "*"}
+
+# Characters and constructs in text that have a meaning in MediaWiki or RST
+# markup, for which render_simple() defers to pandoc.
+UNSAFE_TEXT = re.compile(r"[*`_|\\\[\]{}<>\x02]|''|::|~~~")
+
+# Lines that MediaWiki would turn into lists, headings or preformatted text,
+# or that docutils would read as an enumerated list ("1.", "A)", "iv.",
+# "(a)"), which pandoc escapes.
+UNSAFE_LINE = re.compile(r"^([ \t]+\S|[-:;#=*+]|\w+[.)](\s|$)|\(\w+\)(\s|$))", re.M)
+
+def render_simple(elem):
+    """ Converts an element that only contains code blocks, plain text and
+    bold/italic text directly to RST.  Returns None if the element contains
+    anything else, in which case it needs to go through pandoc. """
+
+    # The text with every tag replaced by a word character, to check what
+    # the lines start with.
+    skeleton = []
+    parts = []
+
+    for child in elem.children:
+        if type(child) is NavigableString:
+            text = str(child)
+            if UNSAFE_TEXT.search(text):
+                return None
+            skeleton.append(text)
+            parts.append((text, "text"))
+
+        elif isinstance(child, Tag) and child.name in CODE:
+            out = Code(child).output()
+            skeleton.append("X")
+            if "\n" in out:
+                parts.append((out.strip("\n"), "block"))
+            else:
+                parts.append((out, "inline"))
+
+        elif isinstance(child, Tag) and child.name in SIMPLE_KEEP:
+            text = child.string
+            if not text or text != text.strip() or "\n" in text or UNSAFE_TEXT.search(text):
+                return None
+            skeleton.append("X")
+            markup = SIMPLE_KEEP[child.name]
+            parts.append((markup + str(text) + markup, "inline"))
+
+        else:
+            return None
+
+    if UNSAFE_LINE.search("".join(skeleton).strip("\n")):
+        return None
+
+    res = ""
+    prev = None
+    for text, kind in parts:
+        if kind == "block":
+            # Code blocks go in their own paragraph.
+            res = res.rstrip()
+            if res:
+                res += "\n\n"
+            res += text + "\n\n"
+        else:
+            if prev == "block":
+                text = text.lstrip()
+            # Inline markup must be separated from adjacent words.
+            if res and text and "inline" in (kind, prev) and \
+                    not res[-1].isspace() and not text[0].isspace() and \
+                    (res[-1].isalnum() or text[0].isalnum()):
+                res += " "
+            res += text
+        prev = kind
+
+    return res.strip("\n") + "\n"
 
 
 class Pandoc(object):
+
+    def __init__(self):
+        self.buffer = []
+        self.converters = {}
     
     def write(self, s):
-        self.pipe.stdin.write(s.encode("utf-8"))
+        self.buffer.append(s)
 
     def placeholder(self, conv, elem):
         global CONTENTS
-        h = sha1(str(elem).encode("utf-8")).hexdigest()
-        CONTENTS[h] = conv(elem)
+        h, payload = serialize(elem)
+        if h not in CONTENTS:
+            CONTENTS[h] = conv(elem, h, payload)
+        # Every scope waits for its own fragments before it replaces their
+        # placeholders, even if they were already created by another.
+        self.converters[h] = CONTENTS[h]
         self.write("XXXREPLACE-" + h + "XXX")
         
     
@@ -185,15 +435,113 @@ class Pandoc(object):
             raise RuntimeError("Unknown type "+str(type(elem)))
 
 
-    def convert(self, root):
-        self.pipe = subprocess.Popen(["pandoc", "-fmediawiki-auto_identifiers", "-trst", '-F./filter.py', NOWRAP], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        #pipe = subprocess.Popen(["cat"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    def collect(self, root):
+        """ Writes out the given elements, creating converters for the
+        fragments.  After this, the elements are no longer needed. """
 
         for elem in root:
             self.handle(elem)
 
-        self.pipe.stdin.close()
-        return self.pipe
+    async def run(self):
+        """ Returns the RST with placeholders for the fragments, which have
+        all been rendered by then. """
+
+        # The fragments don't depend on the surrounding text, so they can be
+        # converted at the same time as it.
+        args = ["-fmediawiki-auto_identifiers", "-trst", '-F./filter.py', NOWRAP]
+        converted = pandoc(args, "".join(self.buffer))
+        results = await asyncio.gather(converted, *(conv.rendered() for conv in self.converters.values()))
+        return results[0]
+
+
+# The containers in which astfilter.py puts the language blocks.
+ONLY_RE = re.compile(r"^(\s*)\.\. container:: only-(\w+)[ \t]*$", re.M)
+
+class AstPandoc(Pandoc):
+    """ Converts a page with a single pandoc run, in which astfilter.py
+    expands the placeholders in the document tree.  Code is converted here,
+    HTML fragments are converted to pandoc's JSON format beforehand (all in
+    one pandoc run, and only those that aren't cached), and the contents of
+    language blocks stay in the page text, between markers. """
+
+    def __init__(self):
+        super().__init__()
+        self.fragments = {}
+        self.html = {}
+
+    def placeholder(self, conv, elem):
+        h, payload = serialize(elem)
+        if h not in self.fragments and h not in self.html:
+            if conv is HTML:
+                self.html[h] = payload
+            else:
+                self.fragments[h] = {"rst": conv(elem, h, payload).output()}
+        self.write("XXXREPLACE-" + h + "XXX")
+
+    def handle(self, elem):
+        if isinstance(elem, Tag) and elem.name in LANG_SWITCH:
+            lang = elem.name
+            if lang == 'cxx':
+                lang = 'cpp'
+
+            self.write("\n\nXXXBEGIN-" + lang + "XXX\n\n")
+            for ch in elem.children:
+                self.handle(ch)
+            self.write("\n\nXXXENDXXX\n\n")
+        else:
+            super().handle(elem)
+
+    async def render_html(self):
+        """ Converts the HTML fragments to lists of pandoc blocks. """
+
+        pending = {}
+        for h, html in self.html.items():
+            path = fragment_cache_path("HTMLAst", h, ".json")
+            if path and os.path.isfile(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    self.fragments[h] = {"blocks": json.load(f)}
+            else:
+                pending[h] = html
+
+        if not pending:
+            return
+
+        data = b"".join(b'<div id="XXXFRAG-' + h.encode("ascii") + b'">\n' + html + b'\n</div>\n'
+                        for h, html in pending.items())
+        doc = json.loads(await pandoc(["-fhtml", "-tjson"], data))
+        blocks = doc["blocks"] if isinstance(doc, dict) else doc[1]
+
+        for block in blocks:
+            if block["t"] != "Div" or not block["c"][0][0].startswith("XXXFRAG-"):
+                continue
+            h = block["c"][0][0][8:]
+            self.fragments[h] = {"blocks": block["c"][1]}
+
+            path = fragment_cache_path("HTMLAst", h, ".json")
+            if path:
+                write_cache(path, json.dumps(block["c"][1]))
+
+        for h in pending:
+            if h not in self.fragments:
+                raise RuntimeError("HTML fragment {} went missing in pandoc".format(h))
+
+    async def run(self):
+        """ Returns the finished RST. """
+
+        await self.render_html()
+
+        fd, path = tempfile.mkstemp(suffix=".json")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self.fragments, f)
+            os.environ["CONVERT_FRAGMENTS"] = path
+
+            args = ["-fmediawiki-auto_identifiers", "-trst", '-F./astfilter.py', NOWRAP]
+            converted = await pandoc(args, "".join(self.buffer))
+        finally:
+            os.remove(path)
+
+        return ONLY_RE.sub(r"\1.. only:: \2", converted)
 
 
 class CData:
@@ -286,7 +634,17 @@ data = re.sub(r"\[/?func\]", "", data)
 
 root = BeautifulSoup(data, 'html.parser')
 
-pipe = Pandoc().convert(root)
+if CONVERT_MODE == 'ast':
+    page = AstPandoc()
+else:
+    page = Pandoc()
+page.collect(root)
+
+# Everything that is needed of the parsed page has been serialised by now.
+root.decompose()
+del root
+
+converted = asyncio.run(page.run())
 
 
 if False:
@@ -300,11 +658,13 @@ if False:
 
 """)
 
-for i, line in enumerate(pipe.stdout):
-    line = line.decode("utf-8")
+for i, line in enumerate(converted.splitlines(True)):
     # restore escaped <
     line = line.replace('\2', '<')
     #sys.stdout.write(line)
 
-    sys.stdout.write(replace_placeholders(line))
+    if CONVERT_MODE == 'ast':
+        sys.stdout.write(line)
+    else:
+        sys.stdout.write(replace_placeholders(line))
 
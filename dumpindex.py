@@ -0,0 +1,111 @@
+""" Index of the byte offsets of the pages in an uncompressed MediaWiki XML
+dump, used by foo.py --page to convert a single page without parsing the
+entire dump.
+
+The index is stored next to the dump as <dump>.index.json and rebuilt
+automatically when the size or modification time of the dump changes. """
+
+import os
+import re
+import json
+import mmap
+from html import unescape
+
+from common import dump_decompressors
+
+# Bump this when changing the format of the index file.
+VERSION = 1
+
+PAGE_RE = re.compile(rb'<page>.*?</page>', re.S)
+TITLE_RE = re.compile(rb'<title>(.*?)</title>', re.S)
+NAMESPACE_RE = re.compile(rb'<mediawiki\b[^>]*?\bxmlns="([^"]*)"')
+
+
+def index_path(fn):
+    return fn + '.index.json'
+
+
+def dump_stamp(fn):
+    """ Returns what identifies this version of the dump. """
+
+    st = os.stat(fn)
+    return {'version': VERSION, 'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+
+def map_dump(fn):
+    """ Memory-maps the given dump, which must not be compressed. """
+
+    with open(fn, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    for prefix, decompressor in dump_decompressors:
+        if data[:len(prefix)] == prefix:
+            data.close()
+            raise ValueError("{} is compressed; decompress it first to look up single pages".format(fn))
+
+    return data
+
+
+def build_index(fn):
+    """ Scans the dump and returns the index as a dictionary. """
+
+    index = dump_stamp(fn)
+    index['namespace'] = ''
+    index['pages'] = {}
+
+    data = map_dump(fn)
+    try:
+        match = NAMESPACE_RE.search(data, 0, 4096)
+        if match:
+            index['namespace'] = match.group(1).decode('utf-8')
+
+        for match in PAGE_RE.finditer(data):
+            title = TITLE_RE.search(data, match.start(), match.end())
+            if title:
+                title = unescape(title.group(1).decode('utf-8'))
+                index['pages'][title] = [match.start(), match.end() - match.start()]
+    finally:
+        data.close()
+
+    return index
+
+
+def load_index(fn):
+    """ Returns the index of the given dump, building and storing it first if
+    there is none or if the dump has changed since. """
+
+    path = index_path(fn)
+    stamp = dump_stamp(fn)
+
+    if os.path.isfile(path):
+        try:
+            index = json.load(open(path, 'r'))
+        except ValueError:
+            index = None
+
+        if index and all(index.get(key) == value for key, value in stamp.items()):
+            return index
+
+    index = build_index(fn)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+    return index
+
+
+def read_pages(fn, index, titles):
+    """ Returns the XML of the <page> elements with the given titles, wrapped
+    in a root element with the namespace of the dump, ready to be parsed.
+    Raises KeyError if a page is not in the dump. """
+
+    data = map_dump(fn)
+    try:
+        chunks = []
+        for title in titles:
+            offset, length = index['pages'][title]
+            chunks.append(data[offset:offset + length])
+    finally:
+        data.close()
+
+    root = '<mediawiki xmlns="{}">'.format(index['namespace']).encode('utf-8')
+    return root + b'\n'.join(chunks) + b'</mediawiki>'
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+""" Keeps a local copy of the manual's pages up to date with the wiki, and
+writes it out as an XML dump for foo.py, so that the whole export does not
+have to be downloaded again every time.
+
+The pages are kept in a store directory (page-store/ by default), with one
+file for the <page> element of each page and a state.json that remembers
+the order of the pages, the newest revision timestamp seen, and the ETag
+and Last-Modified headers of the last full download.
+
+ * Without --api, the full export at --url is requested conditionally, so
+   it is only downloaded again if it changed on the server.
+ * With --api, the URL of the wiki's api.php, only the pages that appear in
+   the recent changes since the newest revision in the store are exported
+   and merged into the store; pages that were deleted or moved away are
+   removed.  The recent changes only go back so far, so a full download is
+   done instead if the store is older than --max-age days.
+
+The dump is only rewritten if a page changed, so that watch.py and make do
+not consider it changed otherwise. """
+
+import os
+import io
+import re
+import sys
+import json
+import shutil
+import argparse
+import urllib.parse
+import urllib.request
+import urllib.error
+from hashlib import sha1
+from html import unescape
+from datetime import datetime, timedelta, timezone
+
+from common import dump_decompressors
+from dumpindex import PAGE_RE, TITLE_RE, NAMESPACE_RE
+
+DUMP_URL = 'https://www.panda3d.org/manual/dump.xml'
+STORE_DIR = 'page-store'
+
+# The namespace that foo.py expects, used if the dump does not have one.
+NAMESPACE = 'http://www.mediawiki.org/xml/export-0.6/'
+
+# MediaWiki keeps the recent changes for 90 days by default ($wgRCMaxAge).
+MAX_AGE_DAYS = 90
+
+# How many titles to export with a single API request.
+EXPORT_BATCH = 50
+
+TIMESTAMP_RE = re.compile(rb'<timestamp>([^<]*)</timestamp>')
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+USER_AGENT = 'panda3d-manual-converter'
+
+
+def page_title(data):
+    match = TITLE_RE.search(data)
+    return unescape(match.group(1).decode('utf-8')) if match else None
+
+
+def page_timestamp(data):
+    """ Returns the timestamp of the newest revision in the <page> element. """
+
+    return max((ts.decode('utf-8') for ts in TIMESTAMP_RE.findall(data)), default='')
+
+
+def split_pages(data):
+    """ Returns the namespace of the export and a list of (title, <page>
+    element) pairs, in the order in which they appear. """
+
+    match = NAMESPACE_RE.search(data, 0, 4096)
+    namespace = match.group(1).decode('utf-8') if match else None
+
+    pages = []
+    for match in PAGE_RE.finditer(data):
+        title = page_title(match.group(0))
+        if title is not None:
+            pages.append((title, match.group(0)))
+
+    return namespace, pages
+
+
+def decompress(data):
+    """ Decompresses the data if it is a gzip, bzip2 or xz compressed dump. """
+
+    for prefix, decompressor in dump_decompressors:
+        if data.startswith(prefix):
+            with decompressor(io.BytesIO(data), 'rb') as f:
+                return f.read()
+    return data
+
+
+def request(url, headers={}):
+    """ Performs a GET request, returning the response, or None if the
+    server answered that the resource was not modified. """
+
+    req = urllib.request.Request(url, headers=dict(headers, **{'User-Agent': USER_AGENT}))
+    try:
+        return urllib.request.urlopen(req)
+    except urllib.error.HTTPError as ex:
+        if ex.code == 304:
+            return None
+        raise
+
+
+def unconditional_request(url):
+    """ Performs a GET request that the server has no reason to answer with
+    304 Not Modified, since no conditional headers are sent. """
+
+    response = request(url)
+    if response is None:
+        sys.exit("{} answered 304 Not Modified to an unconditional request".format(url))
+    return response
+
+
+def api_request(api, params):
+    url = api + '?' + urllib.parse.urlencode(dict(params, format='json'))
+    with unconditional_request(url) as response:
+        return json.load(response)
+
+
+class PageStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.pages_dir = os.path.join(path, 'pages')
+        self.state = {'order': [], 'since': '', 'namespace': NAMESPACE}
+        self.changed = False
+
+        state_path = os.path.join(path, 'state.json')
+        if os.path.isfile(state_path):
+            with open(state_path, 'r', encoding='utf-8') as f:
+                self.state.update(json.load(f))
+
+    def is_empty(self):
+        return not self.state['order']
+
+    def page_path(self, title):
+        return os.path.join(self.pages_dir, sha1(title.encode('utf-8')).hexdigest() + '.xml')
+
+    def read(self, title):
+        with open(self.page_path(title), 'rb') as f:
+            return f.read()
+
+    def put(self, title, data):
+        """ Stores the <page> element of the given title, unless the stored
+        one is the same or newer. """
+
+        path = self.page_path(title)
+        if title in self.state['order']:
+            old = self.read(title)
+            if old == data or page_timestamp(old) > page_timestamp(data):
+                return False
+        else:
+            self.state['order'].append(title)
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+        self.state['since'] = max(self.state['since'], page_timestamp(data))
+        self.changed = True
+        return True
+
+    def remove(self, title):
+        if title not in self.state['order']:
+            return False
+
+        self.state['order'].remove(title)
+        os.remove(self.page_path(title))
+        self.changed = True
+        return True
+
+    def replace_all(self, namespace, pages):
+        """ Replaces the contents of the store with the given pages. """
+
+        if [title for title, data in pages] == self.state['order'] and \
+           all(self.read(title) == data for title, data in pages):
+            return
+
+        if os.path.isdir(self.pages_dir):
+            shutil.rmtree(self.pages_dir)
+        os.makedirs(self.pages_dir)
+
+        self.state['order'] = []
+        self.state['since'] = ''
+        self.state['namespace'] = namespace or NAMESPACE
+        for title, data in pages:
+            self.put(title, data)
+        self.changed = True
+
+    def save(self):
+        if not os.path.isdir(self.pages_dir):
+            os.makedirs(self.pages_dir)
+
+        state_path = os.path.join(self.path, 'state.json')
+        with open(state_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(state_path + '.tmp', state_path)
+
+    def write_dump(self, fn):
+        """ Writes all pages as a MediaWiki XML dump, in their original order,
+        with the main page first, as foo.py expects. """
+
+        order = self.state['order']
+        if 'Main Page' in order:
+            order = ['Main Page'] + [title for title in order if title != 'Main Page']
+
+        with open(fn + '.tmp', 'wb') as f:
+            f.write('<mediawiki xmlns="{}">\n'.format(self.state['namespace']).encode('utf-8'))
+            for title in order:
+                f.write(self.read(title))
+                f.write(b'\n')
+            f.write(b'</mediawiki>\n')
+        os.replace(fn + '.tmp', fn)
+
+
+def fetch_full(store, url):
+    """ Downloads the full export, if it changed since the last download, and
+    replaces the contents of the store with it. """
+
+    headers = {}
+    if not store.is_empty():
+        if store.state.get('etag'):
+            headers['If-None-Match'] = store.state['etag']
+        if store.state.get('last_modified'):
+            headers['If-Modified-Since'] = store.state['last_modified']
+
+    print("Downloading {}".format(url))
+    response = request(url, headers)
+    if response is None:
+        print("The export has not changed.")
+        return
+
+    with response:
+        data = decompress(response.read())
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+    namespace, pages = split_pages(data)
+    if not pages:
+        sys.exit("There are no pages in {}".format(url))
+
+    store.replace_all(namespace, pages)
+    store.state['url'] = url
+    store.state['etag'] = etag
+    store.state['last_modified'] = last_modified
+    print("Stored {} pages.".format(len(pages)))
+
+
+def recent_changes(api, since):
+    """ Returns the titles of the pages that were changed, created, deleted
+    or moved since the given timestamp, and the newest timestamp seen. """
+
+    params = {'action': 'query', 'list': 'recentchanges', 'rcdir': 'newer',
+              'rcstart': since, 'rcprop': 'title|timestamp|loginfo',
+              'rclimit': 500, 'continue': ''}
+    titles = set()
+    newest = since
+
+    while True:
+        data = api_request(api, params)
+        for change in data['query']['recentchanges']:
+            titles.add(change['title'])
+            newest = max(newest, change['timestamp'])
+
+            # A moved page is found under its new title.
+            logparams = change.get('logparams') or {}
+            if logparams.get('target_title'):
+                titles.add(logparams['target_title'])
+
+        if 'continue' in data:
+            params.update(data['continue'])
+        elif 'query-continue' in data:
+            # Before MediaWiki 1.26
+            params.update(data['query-continue']['recentchanges'])
+        else:
+            return titles, newest
+
+
+def export_pages(api, titles):
+    """ Returns the namespace and the (title, <page> element) pairs of the
+    given titles, leaving out the ones that don't exist. """
+
+    namespace = None
+    pages = []
+    titles = sorted(titles)
+    for i in range(0, len(titles), EXPORT_BATCH):
+        params = {'action': 'query', 'export': '', 'exportnowrap': '',
+                  'titles': '|'.join(titles[i:i + EXPORT_BATCH])}
+        url = api + '?' + urllib.parse.urlencode(params)
+        with unconditional_request(url) as response:
+            namespace, batch = split_pages(decompress(response.read()))
+        pages += batch
+
+    return namespace, pages
+
+
+def fetch_changes(store, api):
+    """ Merges the pages that changed since the last run into the store. """
+
+    since = store.state['since']
+    print("Looking for changes since {}".format(since))
+    titles, newest = recent_changes(api, since)
+    if not titles:
+        print("No pages have changed.")
+        return
+
+    namespace, pages = export_pages(api, titles)
+    num_updated = 0
+    for title, data in pages:
+        if store.put(title, data):
+            num_updated += 1
+        titles.discard(title)
+
+    # Whatever was not exported no longer exists under that title.
+    num_removed = 0
+    for title in titles:
+        if store.remove(title):
+            num_removed += 1
+
+    store.state['since'] = max(store.state['since'], newest)
+    print("Updated {} pages, removed {}.".format(num_updated, num_removed))
+
+
+def is_too_old(since, max_age):
+    try:
+        since = datetime.strptime(since, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return True
+    return datetime.now(timezone.utc) - since > timedelta(days=max_age)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Updates a local copy of the manual's pages and writes it as an XML dump for foo.py.")
+    parser.add_argument('output', nargs='?', default='dump.xml',
+                        help="the dump to write (default: dump.xml)")
+    parser.add_argument('--url', default=DUMP_URL,
+                        help="the full XML export of the manual (default: {})".format(DUMP_URL))
+    parser.add_argument('--api', metavar='URL',
+                        help="the api.php of the wiki, to only fetch the pages that changed")
+    parser.add_argument('--store', default=STORE_DIR,
+                        help="directory to keep the pages in (default: {})".format(STORE_DIR))
+    parser.add_argument('--max-age', type=float, default=MAX_AGE_DAYS,
+                        help="days after which to download everything again instead of the recent changes (default: {})".format(MAX_AGE_DAYS))
+    parser.add_argument('--full', action='store_true',
+                        help="download the full export, even if it may not have changed")
+    args = parser.parse_args()
+
+    store = PageStore(args.store)
+    if args.full:
+        store.state['etag'] = None
+        store.state['last_modified'] = None
+
+    if args.full or not args.api or store.is_empty() or is_too_old(store.state['since'], args.max_age):
+        fetch_full(store, args.url)
+    else:
+        fetch_changes(store, args.api)
+
+    # The state is saved even if no page changed, since the ETag or the
+    # timestamp of the recent changes may have moved on.
+    store.save()
+    if store.changed or not os.path.isfile(args.output):
+        store.write_dump(args.output)
+        print("Wrote {} pages to {}.".format(len(store.state['order']), args.output))
+    else:
+        print("{} is up to date.".format(args.output))
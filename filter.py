@@ -40,4 +40,5 @@ def convert_links(key, value, format, meta):
         # remove caption, replace space with underscore
         return Image(value[0], value[1], [transform_title(x) for x in value[2]])
 
-toJSONFilter(convert_links)
+if __name__ == '__main__':
+    toJSONFilter(convert_links)
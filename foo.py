@@ -1,24 +1,84 @@
 from lxml import etree
 import sys
 import os
+import time
 import subprocess
 import shutil
 import json
+import argparse
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from common import *
+from workqueue import WorkQueue, LEASE_SECONDS, POLL_INTERVAL
 
 # Pages under these namespaces won't be converted.
 ignore_namespaces = ['Category', 'Dev', 'File', 'Help', 'MediaWiki',
                      'Panda3D Manual', 'Panda3D Wiki', 'Talk',
                      'Template', 'User talk', 'User']
 
+parser = argparse.ArgumentParser(description="Converts a MediaWiki XML dump of the manual to RST files in source/.")
+parser.add_argument('dump', help="the MediaWiki XML export, optionally compressed with gzip, bzip2 or xz, or - for stdin")
+parser.add_argument('--optimize-images', action='store_true',
+                    help="recompress images and generate downscaled variants (see images.py)")
+parser.add_argument('--resume', action='store_true',
+                    help="skip pages that were already converted by an earlier, interrupted run")
+parser.add_argument('--ast', action='store_true',
+                    help="convert each page with a single pandoc run (sets CONVERT_MODE=ast for convert.py)")
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                    help="number of pages to convert at the same time (default: number of CPUs)")
+parser.add_argument('--queue', metavar='DIR',
+                    help="put the pages in a work queue in this directory, to be converted by workqueue.py workers on "
+                         "any host that shares it; --jobs sets the number of local workers, which may be 0")
+parser.add_argument('--lease', type=float, default=LEASE_SECONDS,
+                    help="seconds after which a queued page of an unresponsive worker is given to another worker")
+parser.add_argument('--split-languages', action='store_true',
+                    help="also write source-python/ and source-cpp/ with the language blocks resolved (see splitlang.py)")
+parser.add_argument('--page', metavar='TITLE',
+                    help="only convert the page with this title, looking it up in an index of the dump (see dumpindex.py)")
+args = parser.parse_args()
+
+# Every converted page is recorded here, so that an interrupted run can be
+# continued with --resume.
+JOURNAL_FILE = 'convert-journal.jsonl'
+
+if args.optimize_images:
+    import images
+
+if args.ast:
+    os.environ['CONVERT_MODE'] = 'ast'
+
+# Share the CPUs between the pages converted at the same time, unless the
+# number of pandoc runs per page is set explicitly.
+os.environ.setdefault('PANDOC_JOBS', str(max(2, (os.cpu_count() or 1) // max(1, args.jobs))))
+
 # Create the pages dir, if it doesn't exist.
 if not os.path.isdir('pages'):
     os.mkdir('pages')
 
 # Parse the MediaWiki xml dump.
-with open(sys.argv[1]) as f:
-    root = etree.parse(f)
+if args.page:
+    # We only need the main page, for the table of contents, and the page
+    # we are converting.
+    import dumpindex
+
+    if args.dump == '-':
+        parser.error("--page needs a dump file, not stdin")
+
+    titles = ['Main Page']
+    if args.page != 'Main Page':
+        titles.append(args.page)
+
+    try:
+        index = dumpindex.load_index(args.dump)
+        root = etree.fromstring(dumpindex.read_pages(args.dump, index, titles))
+    except ValueError as ex:
+        parser.error(str(ex))
+    except KeyError:
+        parser.error("there is no page titled {!r} in {}".format(args.page, args.dump))
+else:
+    with open_dump(args.dump) as f:
+        root = etree.parse(f)
 
 NS = dict(e = "http://www.mediawiki.org/xml/export-0.6/")
 
@@ -58,8 +118,12 @@ with open("source/index.rst", "wb") as f:
         f.write(b'\n')
 
 
-# Find all of the redirects.
+# Find all of the redirects.  When converting a single page, we don't see
+# the others, so we use those found by the last full run.
 redirects = {}
+if args.page and os.path.isfile('redirects.json'):
+    redirects = json.load(open('redirects.json', 'r'))
+
 for page in pages:
     title = page.xpath("e:title/text()", namespaces=NS)[0]
     t = page.xpath(".//e:text/text()", namespaces=NS)
@@ -74,13 +138,80 @@ for page in pages:
         redirects[title] = target
 
 # Store the redirects to disk.
-json.dump(redirects, open('redirects.json', 'w'))
+if not args.page:
+    json.dump(redirects, open('redirects.json', 'w'))
+
+
+# The output of a page also depends on the converter scripts and on the
+# toctree and redirects, which are written above.
+converter_hash = sha1(os.environ.get('CONVERT_MODE', '').encode('utf-8'))
+for fn in CONVERTER_DEPENDENCIES:
+    if not os.path.isfile(fn):
+        continue
+    with open(fn, 'rb') as f:
+        converter_hash.update(f.read())
+
+def page_hash(title, text):
+    h = converter_hash.copy()
+    h.update(title.encode('utf-8'))
+    h.update(b'\0')
+    h.update(text.encode('utf-8'))
+    return h.hexdigest()
+
+# Read back the journal of the previous run.  When resuming, pages that it
+# lists are skipped, otherwise it is only used for the conversion times.
+journal = {}
+if os.path.isfile(JOURNAL_FILE):
+    for line in open(JOURNAL_FILE, 'r'):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # Last line may be cut off if we were killed while writing it.
+            continue
+        journal[entry['path']] = entry
+
+journal_file = open(JOURNAL_FILE, 'a' if args.resume or args.page else 'w')
+num_skipped = 0
+
+def record_page(path, digest, output, seconds):
+    journal_file.write(json.dumps({'path': path, 'hash': digest, 'output': output, 'seconds': round(seconds, 3)}) + '\n')
+    journal_file.flush()
+    os.fsync(journal_file.fileno())
+
+
+def estimate_cost(text):
+    """ Returns a rough measure of how long a page takes to convert, based on
+    its length and the number of fragments that need their own pandoc run. """
+
+    tables = text.count('<table') + text.count('{|')
+    langs = text.count('[python]') + text.count('[cxx]')
+    return 1.0 + len(text) / 2000.0 + 2.0 * tables + langs
+
+
+def schedule(jobs):
+    """ Orders the jobs so that the ones that take longest go first, so that
+    no worker is still busy with a big page at the end while the others sit
+    idle.  Pages that were converted before are estimated by the time they
+    took then, the others by estimate_cost(), scaled to seconds. """
 
+    timed = [(job, journal[job[0]]['seconds']) for job in jobs
+             if 'seconds' in journal.get(job[0], {})]
+    scale = 1.0
+    if timed:
+        scale = sum(seconds for job, seconds in timed) / sum(estimate_cost(job[2]) for job, seconds in timed)
 
-# Convert all of the other pages.
-for i, page in enumerate(pages):
-    progress = (100 * i) // (len(pages) - 1)
+    def cost(job):
+        entry = journal.get(job[0], {})
+        if 'seconds' in entry:
+            return entry['seconds']
+        return scale * estimate_cost(job[2])
 
+    return sorted(jobs, key=cost, reverse=True)
+
+
+# Find the pages to convert.
+jobs = []
+for page in pages:
     title = page.xpath("e:title/text()", namespaces=NS)[0]
     if title in redirects:
         # Ignore redirects.
@@ -91,7 +222,6 @@ for i, page in enumerate(pages):
         if namespace in ignore_namespaces:
             continue
 
-    transformed = transform_title(title)
     path = get_page_path(title)
 
     if not path:
@@ -112,6 +242,13 @@ for i, page in enumerate(pages):
     assert path not in paths
     paths.add(path)
 
+    output = "source/{}.rst".format(path)
+    digest = page_hash(title, t)
+    entry = journal.get(path)
+    if args.resume and entry and entry['hash'] == digest and os.path.isfile(entry['output']):
+        num_skipped += 1
+        continue
+
     # Make sure the parent directory exists.
     parent = 'source'
     if '/' in path:
@@ -127,37 +264,106 @@ for i, page in enumerate(pages):
             print("\nWarning: missing image %s" % (source))
             continue
         target = os.path.join(parent, name)
+        if args.optimize_images:
+            source, variants = images.optimize(source)
+            for width, variant in variants:
+                shutil.copyfile(variant, os.path.join(parent, images.variant_name(name, width)))
         shutil.copyfile(source, target)
         num_images += 1
 
-    with open("source/{}.rst".format(path), "wb") as f:
-        #print("converting %s" % (path))
-        print("\x1b[1Fconverting [%+3s%%] \x1b[1m%s\x1b[m\x1b[K" % (progress, path))
-
-        # Write an anchor so we can refer to this page.
-        f.write(".. _{}:\n\n".format(transformed).encode('utf-8'))
-        f.flush()
-
-        handle = subprocess.Popen(["./convert.py", "-"], stdin=subprocess.PIPE, stdout=f)
-
-        # Prepend a first-level header containing the page title.
-        data = "= {} =\n". format(title.replace('CXX', 'C++')).encode("utf-8")
-        data += t.encode("utf-8")
-        handle.communicate(data)
-
-        if handle.returncode != 0:
-            print()
-            num_errors += 1
-
-        # If this page has children, write out a toc tree at the bottom.
-        children = get_page_children(title)
-        if children:
-            f.write(b'\n\n.. toctree::\n')
-            f.write(b'   :maxdepth: 2\n')
-            f.write(b'\n')
-
-        for child in children:
-            f.write(b'   ' + (child.encode('utf-8')))
-            f.write(b'\n')
-
+    jobs.append((path, title, t, output, digest))
+
+
+def finish_page(count, path, digest, output, failed, seconds):
+    global num_errors
+
+    progress = (100 * count) // len(jobs)
+    print("\x1b[1Fconverted [%+3s%%] \x1b[1m%s\x1b[m\x1b[K" % (progress, path))
+
+    if failed:
+        print()
+        num_errors += 1
+    else:
+        # Failed pages are not recorded, so that they are retried on --resume.
+        record_page(path, digest, output, seconds)
+
+
+# Convert them, biggest first.
+if args.queue:
+    # Put them in the queue for the workers, in order.
+    queue = WorkQueue(args.queue)
+    run_id = queue.create()
+    names = set()
+    for n, (path, title, t, output, digest) in enumerate(schedule(jobs)):
+        name = '{}-{:06d}'.format(run_id, n)
+        names.add(name)
+        queue.put(name, {'path': path, 'title': title, 'hash': digest, 'output': output,
+                         'text': t, 'children': get_page_children(title)})
+
+    workers = []
+    if args.jobs > 0:
+        workers.append(subprocess.Popen([sys.executable, 'workqueue.py', args.queue,
+                                         '-j', str(args.jobs), '--lease', str(args.lease)]))
+
+    finished = set()
+    workers_exited = None
+    while len(finished) < len(jobs):
+        arrived = False
+        for name in queue.results():
+            if name in names and name not in finished:
+                finished.add(name)
+                arrived = True
+                result = queue.result(name)
+                finish_page(len(finished), result['path'], result['hash'], result['output'],
+                            result['failed'], result['seconds'])
+
+        for name in queue.requeue_expired(args.lease):
+            print("\nRequeued job %s, whose worker stopped responding.\n" % (name))
+
+        # If our own workers are gone, only wait for others while they are
+        # still delivering results.
+        if workers and all(worker.poll() is not None for worker in workers):
+            if arrived or workers_exited is None:
+                workers_exited = time.time()
+            elif time.time() - workers_exited > args.lease:
+                print("\nThe local workers have exited and no other worker finished a page for %d seconds; giving up.\n" % (args.lease))
+                num_errors += len(jobs) - len(finished)
+                break
+
+        if len(finished) < len(jobs):
+            time.sleep(POLL_INTERVAL)
+
+    queue.close()
+    for worker in workers:
+        worker.wait()
+else:
+    # The executor hands out the jobs in the order in which they are submitted.
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for job in schedule(jobs):
+            path, title, t, output, digest = job
+            futures[executor.submit(convert_page, title, t, output, get_page_children(title))] = job
+
+        try:
+            for i, future in enumerate(as_completed(futures)):
+                path, title, t, output, digest = futures[future]
+                failed, seconds = future.result()
+                finish_page(i + 1, path, digest, output, failed, seconds)
+        except KeyboardInterrupt:
+            # Don't start on the pages that are still waiting; they would not
+            # be written to the journal, so --resume would do them again.
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+journal_file.close()
+
+if args.split_languages:
+    import splitlang
+    splitlang.split_all()
+
+if args.page and not paths:
+    print("%s was not converted: it is a redirect, empty or not in the table of contents." % (args.page))
+
+if num_skipped:
+    print("Skipped %d pages that were already converted." % (num_skipped))
 print("Wrote %s files to source/ (%d had errors). %d images copied." % (len(paths), num_errors, num_images))
@@ -6,13 +6,21 @@ It requires a valid makepanda installation with interrogatedb .in
 files in the lib/pandac/input directory. """
 
 from __future__ import print_function
+import time
+
+# Taken before the other imports, so that their cost shows in the timing
+# report at the end.
+START_TIME = time.time()
+
 from collections import defaultdict
 
 __all__ = []
 
 import os
-from io import StringIO
-import panda3d
+import json
+import argparse
+import importlib
+from hashlib import sha1
 import pandac
 from panda3d.interrogatedb import *
 from panda3d import core
@@ -109,37 +117,184 @@ library_titles = {
 }
 
 
+# Records the hashes of the interrogatedb files that the reference was last
+# generated from.  Delete it to force everything to be regenerated.
+MANIFEST_FILE = "apidoc-manifest.json"
+
+# The reference is written to the reference/ directory in here, which is the
+# manual's source directory unless the reference is built as a separate
+# project (see build-reference.py).
+SOURCE_DIR = "source"
+
+
+def process_start_time():
+    """ Returns the time at which this process was started, or None if the
+    system does not tell, which it only does on Linux. """
+
+    try:
+        with open("/proc/self/stat", "r") as f:
+            # The command name may contain spaces, so count from its end.
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + ticks / float(os.sysconf("SC_CLK_TCK"))
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def file_hash(fn):
+    h = sha1()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest(object):
+    """ Keeps track of the interrogatedb input files, so that types from
+    libraries whose database did not change since the last run can be
+    skipped.
+
+    The pages of a library also list the typedef aliases of its types and
+    link to their base classes, which may come from other libraries.  So
+    each library is keyed on the hash of this script and the hashes of the
+    .in files of the library itself and of all libraries that it gets
+    aliases or base classes from, among those that are loaded. """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.old = {}
+        self.new = {}
+        self.done = {}
+        self.generator = file_hash(__file__)
+        self.digests = {}
+
+        if os.path.isfile(fn):
+            self.old = json.load(open(fn, 'r'))
+
+    def scan(self, idb_dir):
+        for in_file in sorted(os.listdir(idb_dir)):
+            if in_file.endswith(".in"):
+                self.digests[in_file[:-3]] = file_hash(os.path.join(idb_dir, in_file))
+
+    def update(self):
+        """ Computes the keys of the libraries from the interrogate data that
+        is currently loaded.  Must be called again after loading more. """
+
+        deps = defaultdict(set)
+
+        def add_bases(lib_name, type):
+            for n in range(interrogate_type_number_of_derivations(type)):
+                deps[lib_name].add(interrogate_type_library_name(interrogate_type_get_derivation(type, n)))
+            for i_ntype in range(interrogate_type_number_of_nested_types(type)):
+                add_bases(lib_name, interrogate_type_get_nested_type(type, i_ntype))
+
+        # Aliases are listed on the page of the type with the same name.
+        libraries_by_name = defaultdict(set)
+        typedefs = []
+        for i_type in range(interrogate_number_of_global_types()):
+            type = interrogate_get_global_type(i_type)
+            if interrogate_type_is_nested(type):
+                continue
+
+            lib_name = interrogate_type_library_name(type)
+            if interrogate_type_is_typedef(type):
+                typedefs.append((lib_name, translated_type_name(interrogate_type_wrapped_type(type))))
+            else:
+                libraries_by_name[translated_type_name(type, scoped=False)].add(lib_name)
+                add_bases(lib_name, type)
+
+        for alias_lib, name in typedefs:
+            for lib_name in libraries_by_name.get(name, ()):
+                deps[lib_name].add(alias_lib)
+
+        self.new = {}
+        for lib_name, digest in self.digests.items():
+            h = sha1((self.generator + digest).encode("ascii"))
+            for dep in sorted(deps[lib_name] - {lib_name}):
+                h.update("\n{}:{}".format(dep, self.digests.get(dep, "")).encode("utf-8"))
+            self.new[lib_name] = h.hexdigest()
+
+    def is_unchanged(self, lib_name):
+        digest = self.new.get(lib_name)
+        return digest is not None and self.old.get(lib_name) == digest
+
+    def mark_done(self, lib_name):
+        if lib_name in self.new:
+            self.done[lib_name] = self.new[lib_name]
+
+    def save(self):
+        """ Stores the new hashes of all libraries that have been processed,
+        keeping the old entries of those that were not. """
+
+        result = dict(self.old)
+        result.update(self.done)
+
+        json.dump(result, open(self.fn, 'w'), indent=1, sort_keys=True)
+
+
+# Set in __main__; None means that everything is always regenerated.
+manifest = None
+
+
+def is_up_to_date(lib_name, fn):
+    return manifest is not None and manifest.is_unchanged(lib_name) and os.path.isfile(fn)
+
+
+def file_matches(fn, data):
+    """ Returns True if the file already has exactly the given contents.  The
+    size is checked first, so that most changed files are never read. """
+
+    try:
+        if os.path.getsize(fn) != len(data):
+            return False
+    except OSError:
+        return False
+
+    return file_hash(fn) == sha1(data).hexdigest()
+
+
 class ReSTWriter(object):
     def __init__(self):
         self._spaces = ""
-        self._buffer = None
+        self._lines = None
 
     def __del__(self):
-        if self._buffer and self._buffer.getvalue():
+        if self._lines:
             self.close()
 
     def _append(self, data):
-        self._buffer += data
+        self._lines.append(data)
 
     def open(self, fn):
         self._fn = fn
-        self._buffer = StringIO()
-        self._write = self._buffer.write
+        self._lines = []
+        self._write = self._lines.append
 
     def close(self):
-        if os.path.isfile(self._fn):
-            current = open(self._fn, 'r').read()
-        else:
-            current = None
-
-        buffer_value = self._buffer.getvalue()
-        if current != buffer_value:
-            print("Writing {}".format(self._fn))
-            open(self._fn, 'w').write(buffer_value)
-        self._buffer = None
+        # Use the line endings of the platform, as text mode would.
+        data = "".join(self._lines).replace("\n", os.linesep).encode("utf-8")
+        self._lines = None
+
+        if file_matches(self._fn, data):
+            return
+
+        # Write to a temporary file first, so that an interrupted run never
+        # leaves a partially written file behind.
+        print("Writing {}".format(self._fn))
+        dirname, basename = os.path.split(self._fn)
+        tmp_fn = os.path.join(dirname, ".{}.{}.tmp".format(basename, os.getpid()))
+        try:
+            with open(tmp_fn, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_fn, self._fn)
+        except OSError:
+            if os.path.exists(tmp_fn):
+                os.unlink(tmp_fn)
+            raise
 
     def discard(self):
-        self._buffer = None
+        self._lines = None
 
     def directive(self, block):
         self._write("\n" + self._spaces + ".. " + block + "\n")
@@ -198,10 +353,35 @@ def comment(code):
         return ''
 
 
+# Parsed comments, keyed by the SHA1 of the raw comment text and whether the
+# extra values were parsed.  Overloads,
+# typedef aliases and nested types very often share the same comment.
+block_comment_cache = {}
+
+
 def block_comment(code, extra=None):
+    """ Converts a C++ doc comment to RST.  If extra is given, it is filled
+    with the @param, @brief, @return(s) and @deprecated values found in it.
+    Results are cached for the duration of the run. """
+
     if not code:
         return ""
 
+    # The values are only parsed when they are asked for, since a @param
+    # without a description or a bare @brief cannot be parsed.
+    key = (sha1(code.encode("utf-8")).hexdigest(), extra is not None)
+    cached = block_comment_cache.get(key)
+    if cached is None:
+        parsed_extra = {} if extra is not None else None
+        cached = (parse_block_comment(code, parsed_extra), parsed_extra)
+        block_comment_cache[key] = cached
+
+    if extra is not None:
+        extra.update(cached[1])
+    return cached[0]
+
+
+def parse_block_comment(code, extra):
     lines = code.split("\n")
     newlines = []
     indent = 0
@@ -421,6 +601,110 @@ def translated_type_name(type, scoped=True):
         return typename
 
 
+# A JSON-lines index of the whole API, written alongside the RST files so that
+# other tools can load the API surface without importing panda3d.
+INVENTORY_FILE = "apidoc-inventory.jsonl"
+
+
+class Inventory(object):
+    """ Collects one JSON record per type, alias and global function. """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self._lines = []
+
+    def add(self, record):
+        self._lines.append(json.dumps(record, sort_keys=True) + "\n")
+
+    def add_function(self, module_name, function):
+        signatures = []
+        for i_wrapper in range(interrogate_function_number_of_python_wrappers(function)):
+            wrapper = interrogate_function_python_wrapper(function, i_wrapper)
+            ftype, fname, sig = wrapper_signature(function, wrapper)
+            rtype = None
+            if interrogate_wrapper_has_return_value(wrapper):
+                rtype = translated_type_name(interrogate_wrapper_return_type(wrapper))
+            signatures.append({"args": sig, "rtype": rtype})
+
+        self.add({
+            "kind": "function",
+            "module": module_name,
+            "library": interrogate_function_library_name(function),
+            "name": translateFunctionName(interrogate_function_name(function)),
+            "signatures": signatures,
+        })
+
+    def add_type(self, module_name, type):
+        name = translated_type_name(type)
+        record = {
+            "module": module_name,
+            "library": interrogate_type_library_name(type),
+            "name": name,
+        }
+
+        if interrogate_type_is_typedef(type):
+            record["kind"] = "alias"
+            record["target"] = translated_type_name(interrogate_type_wrapped_type(type))
+            self.add(record)
+            return
+
+        if interrogate_type_is_enum(type):
+            record["kind"] = "enum"
+            record["values"] = [(interrogate_type_enum_value_name(type, i_value),
+                                 interrogate_type_enum_value(type, i_value))
+                                for i_value in range(interrogate_type_number_of_enum_values(type))]
+            self.add(record)
+            return
+
+        record["kind"] = "class"
+        record["bases"] = [translated_type_name(interrogate_type_get_derivation(type, n))
+                           for n in range(interrogate_type_number_of_derivations(type))]
+
+        methods = []
+        functions = [(interrogate_type_get_constructor(type, i_method), True)
+                     for i_method in range(interrogate_type_number_of_constructors(type))]
+        functions += [(interrogate_type_get_method(type, i_method), False)
+                      for i_method in range(interrogate_type_number_of_methods(type))]
+
+        for function, isConstructor in functions:
+            for i_wrapper in range(interrogate_function_number_of_python_wrappers(function)):
+                wrapper = interrogate_function_python_wrapper(function, i_wrapper)
+                ftype, fname, sig = wrapper_signature(function, wrapper, isConstructor)
+                rtype = None
+                if not isConstructor and interrogate_wrapper_has_return_value(wrapper):
+                    rtype = translated_type_name(interrogate_wrapper_return_type(wrapper))
+                methods.append({"name": fname, "type": ftype, "args": sig, "rtype": rtype})
+
+        record["methods"] = methods
+        record["attributes"] = [interrogate_element_name(interrogate_type_get_element(type, i_element))
+                                for i_element in range(interrogate_type_number_of_elements(type))]
+        self.add(record)
+
+        for i_ntype in range(interrogate_type_number_of_nested_types(type)):
+            self.add_type(module_name, interrogate_type_get_nested_type(type, i_ntype))
+
+    def save(self, module_names=None):
+        """ Writes out the inventory.  If module_names is given, only the
+        records of those modules are replaced in the existing file. """
+
+        lines = self._lines
+        if module_names is not None and os.path.isfile(self.fn):
+            kept = []
+            for line in open(self.fn, 'r'):
+                if json.loads(line)["module"] not in module_names:
+                    kept.append(line)
+            lines = kept + lines
+
+        tmp_fn = self.fn + ".tmp"
+        with open(tmp_fn, 'w') as f:
+            f.writelines(lines)
+        os.replace(tmp_fn, self.fn)
+
+
+# Set in __main__.
+inventory = None
+
+
 def process_element(out, element):
     with out.directive('attribute:: %s' % interrogate_element_name(element)):
         if interrogate_element_has_comment(element):
@@ -438,6 +722,32 @@ def process_element(out, element):
                 out.write("Read-only.  See :py:meth:`{}`.".format(interrogate_function_name(getter)))
 
 
+def wrapper_signature(function, wrapper, isConstructor=False):
+    """ Returns the directive type, the name and the parameter list of the
+    given Python wrapper. """
+
+    if isConstructor:
+        fname = "__init__"
+        ftype = "method"
+    else:
+        fname = translateFunctionName(interrogate_function_name(function))
+        ftype = "method"
+        if interrogate_function_is_method(function):
+            if not interrogate_wrapper_number_of_parameters(wrapper) > 0 or not interrogate_wrapper_parameter_is_this(wrapper, 0):
+                ftype = "staticmethod"
+
+    sig = ""
+    for i_param in range(interrogate_wrapper_number_of_parameters(wrapper)):
+        if not interrogate_wrapper_parameter_is_this(wrapper, i_param):
+            if sig:
+                sig += ", "
+            sig += translated_type_name(interrogate_wrapper_parameter_type(wrapper, i_param))
+            sig += " "
+            sig += interrogate_wrapper_parameter_name(wrapper, i_param)
+
+    return ftype, fname, sig
+
+
 def process_function(out, function, isConstructor = False):
     for i_wrapper in range(interrogate_function_number_of_python_wrappers(function)):
         wrapper = interrogate_function_python_wrapper(function, i_wrapper)
@@ -455,26 +765,7 @@ def process_function(out, function, isConstructor = False):
         #else:
         #    print("   .. cpp:function:: void __init__(", end='')
 
-        if isConstructor:
-            fname = "__init__"
-            ftype = "method"
-        else:
-            fname = translateFunctionName(interrogate_function_name(function))
-            ftype = "method"
-            if interrogate_function_is_method(function):
-                if not interrogate_wrapper_number_of_parameters(wrapper) > 0 or not interrogate_wrapper_parameter_is_this(wrapper, 0):
-                    ftype = "staticmethod"
-
-        sig = ""
-        for i_param in range(interrogate_wrapper_number_of_parameters(wrapper)):
-            if not interrogate_wrapper_parameter_is_this(wrapper, i_param):
-                if sig:
-                    sig += ", "
-                sig += translated_type_name(interrogate_wrapper_parameter_type(wrapper, i_param))
-                sig += " "
-                sig += interrogate_wrapper_parameter_name(wrapper, i_param)
-                #print(" : ", end='')
-                #print(translated_type_name(interrogate_wrapper_parameter_type(wrapper, i_param)), end='')
+        ftype, fname, sig = wrapper_signature(function, wrapper, isConstructor)
 
         with out.directive("py:{}:: {}({})".format(ftype, fname, sig)):
             extra = {}
@@ -608,8 +899,12 @@ def process_global_type(module_name, type):
     if interrogate_type_is_enum(type) and not type_name:
         return
 
+    fn = "{}/reference/{}/{}.rst".format(SOURCE_DIR, module_name, type_name)
+    if is_up_to_date(interrogate_type_library_name(type), fn):
+        return
+
     out = ReSTWriter()
-    out.open("source/reference/{}/{}.rst".format(module_name, type_name))
+    out.open(fn)
 
     description = ""
 
@@ -711,7 +1006,7 @@ def process_library(out, module_name, lib_name):
 
 
 def process_module(module_name):
-    dirname = "source/reference/" + module_name
+    dirname = SOURCE_DIR + "/reference/" + module_name
     if not os.path.isdir(dirname):
         os.mkdir(dirname)
 
@@ -729,6 +1024,9 @@ def process_module(module_name):
 
     libraries = defaultdict(list)
 
+    if manifest is not None:
+        manifest.update()
+
     for i_type in range(interrogate_number_of_global_types()):
         type = interrogate_get_global_type(i_type)
 
@@ -737,11 +1035,24 @@ def process_module(module_name):
 
         if interrogate_type_module_name(type) == module_name:
             process_global_type(module_name, type)
+            if inventory is not None and interrogate_type_is_fully_defined(type) \
+                    and not interrogate_type_is_unpublished(type):
+                inventory.add_type(module_name, type)
             if not interrogate_type_is_typedef(type):
                 lib_name = interrogate_type_library_name(type)
                 typename = translated_type_name(type, scoped=False)
                 libraries[lib_name].append(typename)
 
+            if manifest is not None:
+                manifest.mark_done(interrogate_type_library_name(type))
+
+    if inventory is not None:
+        for i_func in range(interrogate_number_of_global_functions()):
+            func = interrogate_get_global_function(i_func)
+            if interrogate_function_has_module_name(func) and \
+                    interrogate_function_module_name(func) == module_name:
+                inventory.add_function(module_name, func)
+
     out.writeln()
     out.writeln("This module contains the following classes:")
 
@@ -754,8 +1065,12 @@ def process_module(module_name):
             for lib_name, classes in sorted(libraries.items(), key=lambda k: library_ordering.index(k[0]) if k[0] in library_ordering else 100000):
                 out.writeln("../{}".format(lib_name))
 
+                lib_fn = os.path.join(SOURCE_DIR, "reference", lib_name + ".rst")
+                if is_up_to_date(lib_name, lib_fn):
+                    continue
+
                 out2 = ReSTWriter()
-                out2.open(os.path.join("source", "reference", lib_name + ".rst"))
+                out2.open(lib_fn)
                 lib_title = library_titles.get(lib_name, lib_name)
                 out2.writeln(lib_title)
                 out2.writeln("=" * len(lib_title))
@@ -782,50 +1097,79 @@ def process_module(module_name):
     #out.discard()
 
 
-if __name__ == "__main__":
-    if not os.path.isdir("source"):
-        os.mkdir("source")
-    if not os.path.isdir("source/reference"):
-        os.mkdir("source/reference")
-
-    # Determine the path to the interrogatedb files
-    #interrogate_add_search_directory(os.path.join(os.path.dirname(pandac.__file__), "..", "..", "etc"))
-    interrogate_add_search_directory(os.path.join(os.path.dirname(pandac.__file__), "input"))
-
-    process_module("panda3d.core")
+# The modules that are documented, in order.  Importing a module registers
+# its interrogate data, so only the selected ones are imported.  Each module
+# is processed before the next one is imported, since its pages only list
+# the aliases of the modules loaded so far.
+MODULES = [
+    "panda3d.core",
+    "panda3d.direct",
+    "panda3d.egg",
+    "panda3d.fx",
+    "panda3d.physics",
+    "panda3d.vision",
+    "panda3d.ode",
+    "panda3d.bullet",
+    "panda3d.ai",
+]
 
-    import panda3d.direct
-    process_module("panda3d.direct")
 
-    import panda3d.egg
-    process_module("panda3d.egg")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates the API reference in source/reference.")
+    parser.add_argument("--module", action="append", dest="modules", choices=MODULES,
+                        help="only generate the given module (may be repeated)")
+    parser.add_argument("--source-dir", default=SOURCE_DIR,
+                        help="write the reference to the reference/ directory in here (default: source)")
+    args = parser.parse_args()
+
+    # Each output directory keeps its own manifest, since it is up to date
+    # independently of the others.
+    if os.path.normpath(args.source_dir) != SOURCE_DIR:
+        MANIFEST_FILE = "apidoc-manifest-{}.json".format(os.path.basename(os.path.abspath(args.source_dir)))
+    SOURCE_DIR = args.source_dir
+
+    modules = args.modules or MODULES
+    timings = []
+
+    # The interpreter startup is only known where process_start_time() is.
+    started = process_start_time()
+    if started is not None:
+        timings.append(("interpreter startup", max(0.0, START_TIME - started)))
+    else:
+        started = START_TIME
+    timings.append(("module imports", time.time() - START_TIME))
+    start = time.time()
 
-    import panda3d.fx
-    process_module("panda3d.fx")
+    if not os.path.isdir(os.path.join(SOURCE_DIR, "reference")):
+        os.makedirs(os.path.join(SOURCE_DIR, "reference"))
 
-    import panda3d.physics
-    process_module("panda3d.physics")
+    # Determine the path to the interrogatedb files
+    #interrogate_add_search_directory(os.path.join(os.path.dirname(pandac.__file__), "..", "..", "etc"))
+    idb_dir = os.path.join(os.path.dirname(pandac.__file__), "input")
+    interrogate_add_search_directory(idb_dir)
 
-    import panda3d.vision
-    process_module("panda3d.vision")
+    manifest = Manifest(MANIFEST_FILE)
+    manifest.scan(idb_dir)
 
-    import panda3d.ode
-    process_module("panda3d.ode")
+    inventory = Inventory(INVENTORY_FILE)
+    timings.append(("startup", time.time() - start))
 
-    import panda3d.bullet
-    process_module("panda3d.bullet")
+    for module_name in modules:
+        t = time.time()
+        importlib.import_module(module_name)
+        timings.append(("import " + module_name, time.time() - t))
 
-    import panda3d.ai
-    process_module("panda3d.ai")
+        t = time.time()
+        process_module(module_name)
+        timings.append(("process " + module_name, time.time() - t))
 
-    #idb_dir = os.path.join(os.path.dirname(pandac.__file__), "input")
-    #for in_file in os.listdir(idb_dir):
-    #    if in_file.endswith(".in"):
-    #        interrogate_request_database(os.path.join(idb_dir, in_file))
+    manifest.save()
+    if args.modules:
+        inventory.save(modules)
+    else:
+        inventory.save()
 
-    #for lib in os.listdir(os.path.dirname(panda3d.__file__)):
-    #    if lib.endswith(('.pyd', '.so')) and not lib.startswith('core.'):
-    #        module_name = lib.split('.')[0]
-    #        if module_name != 'physx':
-    #            __import__("panda3d." + module_name)
-    #            process_module(module_name)
+    print()
+    for step, duration in timings:
+        print("{:>8.2f} s  {}".format(duration, step))
+    print("{:>8.2f} s  total".format(time.time() - started))
@@ -0,0 +1,116 @@
+""" Optional optimisation of the manual images, used by foo.py when it is
+given --optimize-images.
+
+Each image is recompressed losslessly (optipng or Pillow for PNG, jpegtran
+for JPEG, whichever is available) and, if it is wider than the smallest
+variant width, downscaled copies are generated that the imagevariants
+Sphinx extension offers to browsers through srcset.  Results are cached in
+image-cache/ by a hash of the original file, so only new or changed images
+are processed. """
+
+import os
+import json
+import shutil
+import subprocess
+from hashlib import sha1
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+CACHE_DIR = 'image-cache'
+
+# Widths of the downscaled variants.  Only variants narrower than the
+# original image are generated.
+VARIANT_WIDTHS = [480, 960]
+
+# Bump this when changing how images are processed, to invalidate the cache.
+VERSION = 1
+
+
+def variant_name(name, width):
+    """ Returns the file name of the variant of the given width. """
+
+    stem, ext = os.path.splitext(name)
+    return "{}-{}w{}".format(stem, width, ext)
+
+
+def recompress(source, target):
+    """ Writes a losslessly recompressed copy of source to target, or a
+    plain copy if no suitable tool is available. """
+
+    ext = os.path.splitext(source)[1].lower()
+
+    if ext == '.png' and shutil.which('optipng'):
+        subprocess.check_call(['optipng', '-quiet', '-o2', '-strip', 'all', '-out', target, source])
+    elif ext == '.png' and Image is not None:
+        with Image.open(source) as im:
+            im.save(target, optimize=True)
+    elif ext in ('.jpg', '.jpeg') and shutil.which('jpegtran'):
+        with open(target, 'wb') as f:
+            subprocess.check_call(['jpegtran', '-copy', 'none', '-optimize', '-progressive', source], stdout=f)
+    else:
+        shutil.copyfile(source, target)
+
+    # Never make an image larger.
+    if os.path.getsize(target) >= os.path.getsize(source):
+        shutil.copyfile(source, target)
+
+
+def make_variants(source, cache_base, ext):
+    """ Writes downscaled copies of source, returning their widths. """
+
+    if Image is None:
+        return []
+
+    widths = []
+    with Image.open(source) as original:
+        if getattr(original, 'is_animated', False):
+            return []
+
+        # Palette images would otherwise be scaled without filtering.
+        im = original
+        if im.mode in ('1', 'P'):
+            im = im.convert('RGBA')
+
+        for width in VARIANT_WIDTHS:
+            if width >= im.width:
+                break
+
+            height = max(1, round(im.height * width / im.width))
+            scaled = im.resize((width, height), Image.LANCZOS)
+            target = cache_base + '-{}w{}'.format(width, ext)
+            if ext in ('.jpg', '.jpeg'):
+                scaled.convert('RGB').save(target, quality=90, optimize=True)
+            else:
+                scaled.save(target, optimize=True)
+            widths.append(width)
+
+    return widths
+
+
+def optimize(source):
+    """ Returns the path to an optimised copy of the given image, and a list
+    of (width, path) of its downscaled variants. """
+
+    if not os.path.isdir(CACHE_DIR):
+        os.mkdir(CACHE_DIR)
+
+    ext = os.path.splitext(source)[1].lower()
+    h = sha1(str(VERSION).encode('ascii'))
+    with open(source, 'rb') as f:
+        h.update(f.read())
+
+    cache_base = os.path.join(CACHE_DIR, h.hexdigest())
+    info_fn = cache_base + '.json'
+
+    if os.path.isfile(info_fn):
+        info = json.load(open(info_fn, 'r'))
+    else:
+        recompress(source, cache_base + ext)
+        info = {'variants': make_variants(source, cache_base, ext)}
+        json.dump(info, open(info_fn, 'w'))
+
+    variants = [(width, cache_base + '-{}w{}'.format(width, ext)) for width in info['variants']]
+    return cache_base + ext, variants
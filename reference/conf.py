@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# Configuration for building the Panda3D API reference as a project of its
+# own, separately from the manual in source/.  The pages in reference/ are
+# written by "generate-apidoc.py --source-dir reference", and the manual links
+# to them through the objects.inv of this build; see build-reference.py.
+#
+# This file is execfile()d with the current directory set to its
+# containing dir.
+
+import sys
+import os
+
+# The extensions, templates and static files are shared with the manual.
+sys.path.insert(0, os.path.abspath('../source/_ext'))
+# xrefindex also uses common.py from the top of the checkout.
+sys.path.insert(0, os.path.abspath('..'))
+
+# -- General configuration ------------------------------------------------
+
+extensions = ['sphinx.ext.autodoc', 'xrefindex', 'searchshards']
+
+# Set PANDA3D_BUILDPROFILE to write a report of the time spent on each page.
+if os.environ.get('PANDA3D_BUILDPROFILE'):
+    extensions.append('buildprofile')
+
+templates_path = ['../source/_templates']
+
+source_suffix = '.rst'
+master_doc = 'index'
+
+project = u'Panda3D'
+copyright = u'2019 Carnegie Mellon University'
+
+version = '1.10'
+release = '1.10.3'
+
+exclude_patterns = []
+
+# The reference has no redirected manual pages to resolve labels for, but
+# the inventory gives the short names of the classes.
+xrefindex_redirects = ''
+
+# -- Options for HTML output ----------------------------------------------
+
+html_theme = "sphinx_rtd_theme"
+
+html_theme_options = {
+  'style_nav_header_background': '#735cdd',
+  'logo_only': True,
+  'collapse_navigation': False,
+  'prev_next_buttons_location': 'both',
+  'style_external_links': True
+}
+
+html_title = "Panda3D API Reference"
+html_logo = "../source/_static/logo.png"
+
+html_static_path = ['../source/_static']
+
+html_context = {
+    'css_files': [
+        '_static/panda.css',  # override wide tables in RTD theme
+    ],
+}
+
+htmlhelp_basename = 'Panda3Dref'
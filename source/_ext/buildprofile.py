@@ -0,0 +1,219 @@
+""" Sphinx extension that records how long each document takes to read,
+resolve and write, how much the memory use of the build grows meanwhile,
+and how many cross-references it contains.
+
+It is only enabled when PANDA3D_BUILDPROFILE is set in the environment (see
+conf.py), since the resolve and write times are measured by wrapping the
+methods of the environment and the builder of the build, for which Sphinx
+has no events.
+
+At the end of the build, a JSON report is written to the file named by the
+`buildprofile_output` config value (by default profile.json in the doctree
+directory) and the slowest documents are listed in the build output.
+
+Read times are also collected from parallel (-j) read workers.  Write times
+are only recorded for documents written in the main process, so profile a
+build without -j to get complete write figures. """
+
+import os
+import json
+import time
+from collections import Counter
+
+from docutils import nodes
+from sphinx import addnodes
+from sphinx.errors import ExtensionError
+from sphinx.util import logging
+
+from nodeutils import findall
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Resolve and write statistics are gathered in the main process only, so
+# they are kept here rather than in the (pickled) environment.
+write_stats = {}
+
+# The documents that are (re)read during this build.  The environment keeps
+# the figures of documents read in earlier builds, which are left out.
+read_docnames = set()
+
+# The resident set size at the start of each phase of the build.
+phase_rss = {}
+
+# How many documents to list in the summary.
+SUMMARY_LENGTH = 20
+
+
+def max_rss():
+    """ Returns the peak resident set size of this process in kilobytes. """
+
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def current_rss():
+    """ Returns the current resident set size of this process in kilobytes,
+    or None if it cannot be determined, which is the case on Windows. """
+
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def growth(before, after):
+    if before is None or after is None:
+        return None
+    return after - before
+
+
+def get_read_stats(env):
+    if not hasattr(env, 'buildprofile_read'):
+        env.buildprofile_read = {}
+    return env.buildprofile_read
+
+
+def on_env_before_read_docs(app, env, docnames):
+    read_docnames.update(docnames)
+
+
+def on_source_read(app, docname, source):
+    stats = get_read_stats(app.env)
+    stats[docname] = {'start': time.time(), 'start_rss': current_rss()}
+
+
+def on_doctree_read(app, doctree):
+    docname = app.env.docname
+    stats = get_read_stats(app.env).get(docname)
+    if stats is None or 'start' not in stats:
+        return
+
+    xrefs = Counter()
+    for node in findall(doctree, addnodes.pending_xref):
+        xrefs['{}:{}'.format(node.get('refdomain') or 'std', node.get('reftype'))] += 1
+
+    stats['read'] = time.time() - stats.pop('start')
+    stats['read_rss'] = growth(stats.pop('start_rss', None), current_rss())
+    stats['xrefs'] = dict(xrefs)
+    stats['images'] = len(findall(doctree, nodes.image))
+
+
+def on_env_purge_doc(app, env, docname):
+    get_read_stats(env).pop(docname, None)
+
+
+def on_env_merge_info(app, env, docnames, other):
+    stats = get_read_stats(env)
+    other_stats = get_read_stats(other)
+    for docname in docnames:
+        if docname in other_stats:
+            stats[docname] = other_stats[docname]
+
+
+def timed(func, key):
+    """ Returns a wrapper of the given bound method that records its duration
+    and the growth of the memory use for the document that it is called for
+    under the given key. """
+
+    def wrapper(docname, *args, **kwargs):
+        start = time.time()
+        start_rss = current_rss()
+        result = func(docname, *args, **kwargs)
+        stats = write_stats.setdefault(docname, {})
+        stats[key] = time.time() - start
+        stats[key + '_rss'] = growth(start_rss, current_rss())
+        return result
+
+    return wrapper
+
+
+def on_builder_inited(app):
+    phase_rss.clear()
+    phase_rss['read'] = current_rss()
+    app.builder.write_doc = timed(app.builder.write_doc, 'write')
+
+
+def on_write_started(app, *args):
+    # The environment has been pickled by now, so the wrapper, which only
+    # lives on this instance, is not stored with it.
+    phase_rss.setdefault('write', current_rss())
+
+    env = app.env
+    if 'get_and_resolve_doctree' not in vars(env):
+        env.get_and_resolve_doctree = timed(env.get_and_resolve_doctree, 'resolve')
+
+
+def on_build_finished(app, exception):
+    vars(app.env).pop('get_and_resolve_doctree', None)
+    vars(app.builder).pop('write_doc', None)
+
+    if exception is not None:
+        return
+
+    report = {}
+    for docname, stats in get_read_stats(app.env).items():
+        if docname in read_docnames:
+            report[docname] = dict(stats)
+    for docname, stats in write_stats.items():
+        report.setdefault(docname, {}).update(stats)
+
+    for stats in report.values():
+        stats['total'] = stats.get('read', 0) + stats.get('resolve', 0) + stats.get('write', 0)
+        stats['total_rss'] = sum(stats.get(key + '_rss') or 0 for key in ('read', 'resolve', 'write'))
+
+    # How much the memory use grew while reading and while writing.
+    phases = {}
+    end_rss = current_rss()
+    if 'write' in phase_rss:
+        phases['read'] = growth(phase_rss.get('read'), phase_rss['write'])
+        phases['write'] = growth(phase_rss['write'], end_rss)
+    else:
+        phases['read'] = growth(phase_rss.get('read'), end_rss)
+
+    output = app.config.buildprofile_output or os.path.join(app.doctreedir, 'profile.json')
+    with open(output, 'w') as f:
+        json.dump({'peak_rss': max_rss(), 'rss': end_rss, 'phase_rss': phases, 'documents': report},
+                  f, indent=1, sort_keys=True)
+
+    slowest = sorted(report.items(), key=lambda item: item[1]['total'], reverse=True)
+    logger.info('')
+    logger.info('Slowest documents (read / resolve / write, memory growth, xrefs):')
+    for docname, stats in slowest[:SUMMARY_LENGTH]:
+        logger.info('%8.3f s  %6.3f / %6.3f / %6.3f  %7d kB  %5d  %s',
+                    stats['total'], stats.get('read', 0), stats.get('resolve', 0),
+                    stats.get('write', 0), stats['total_rss'],
+                    sum(stats.get('xrefs', {}).values()), docname)
+    for phase, label in (('read', 'reading'), ('write', 'writing')):
+        if phases.get(phase) is not None:
+            logger.info('Memory growth while %s: %d kB', label, phases[phase])
+    logger.info('Build profile written to %s', output)
+
+
+def setup(app):
+    app.add_config_value('buildprofile_output', None, '')
+
+    app.connect('builder-inited', on_builder_inited)
+    app.connect('env-before-read-docs', on_env_before_read_docs)
+    app.connect('source-read', on_source_read)
+    app.connect('doctree-read', on_doctree_read)
+    app.connect('env-purge-doc', on_env_purge_doc)
+    app.connect('env-merge-info', on_env_merge_info)
+
+    # write-started is new in Sphinx 7.3.  Before that, the consistency check
+    # is the last event before writing, but only if anything was read.
+    try:
+        app.connect('write-started', on_write_started)
+    except ExtensionError:
+        app.connect('env-check-consistency', on_write_started)
+    app.connect('build-finished', on_build_finished)
+
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
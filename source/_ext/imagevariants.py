@@ -0,0 +1,113 @@
+""" Sphinx extension that adds a srcset attribute to images for which
+downscaled variants exist, as generated by foo.py --optimize-images.
+
+A variant of foo.png is a file named foo-<width>w.png next to it.  The
+variants are registered with the builder so that they are copied to
+_images/ along with the original, and the srcset is added to the <img>
+tags when the page is rendered. """
+
+import os
+import re
+
+from sphinx.util.images import get_image_size
+
+# Maps the output file name of an image to a list of (width, output name)
+# of its variants.  Filled in after reading, in the main process, so that it
+# is also available to parallel writer processes.
+variants = {}
+
+IMG_RE = re.compile(r'<img\b[^>]*?\bsrc="([^"]+)"[^>]*?>')
+
+
+def find_variants(srcdir, imgpath):
+    """ Returns a list of (width, path) of the variants of the given image,
+    relative to the source directory. """
+
+    stem, ext = os.path.splitext(imgpath)
+    dirname = os.path.join(srcdir, os.path.dirname(imgpath))
+    prefix = os.path.basename(stem) + '-'
+    pattern = re.compile(re.escape(prefix) + r'(\d+)w' + re.escape(ext) + '$')
+
+    found = []
+    if os.path.isdir(dirname):
+        for fn in os.listdir(dirname):
+            match = pattern.match(fn)
+            if match:
+                found.append((int(match.group(1)), os.path.join(os.path.dirname(imgpath), fn)))
+    return sorted(found)
+
+
+def unique_name(path, used):
+    """ Returns a name for the file in _images/ that is not in used yet, in
+    the same way as Sphinx names the images themselves. """
+
+    name = os.path.basename(path)
+    stem, ext = os.path.splitext(name)
+    i = 0
+    while name in used:
+        i += 1
+        name = '{}{}{}'.format(stem, i, ext)
+    used.add(name)
+    return name
+
+
+def on_env_updated(app, env):
+    builder = app.builder
+    if builder.format != 'html' or not hasattr(builder, 'images'):
+        return
+
+    # Sphinx has given every image a unique output name by now, which is
+    # renamed when several images have the same file name.  The variants get
+    # names that clash with none of them.
+    used = set(outname for docnames, outname in env.images.values())
+    variants.clear()
+
+    for imgpath, (docnames, outname) in sorted(env.images.items()):
+        found = find_variants(app.srcdir, imgpath)
+        if not found:
+            continue
+
+        # The original needs to be in the srcset too, with its width.
+        size = get_image_size(os.path.join(app.srcdir, imgpath))
+        if not size:
+            continue
+
+        entries = []
+        for width, variant in found:
+            if variant in env.images:
+                name = env.images[variant][1]
+            elif variant in builder.images:
+                name = builder.images[variant]
+            else:
+                name = unique_name(variant, used)
+            builder.images[variant] = name
+            entries.append((width, name))
+        entries.append((size[0], outname))
+        variants[outname] = entries
+
+
+def on_html_page_context(app, pagename, templatename, context, doctree):
+    body = context.get('body')
+    if not body or not variants:
+        return
+
+    def add_srcset(match):
+        tag = match.group(0)
+        src = match.group(1)
+        dirname, outname = src.rsplit('/', 1) if '/' in src else ('', src)
+        entries = variants.get(outname)
+        if not entries or 'srcset=' in tag:
+            return tag
+
+        prefix = dirname + '/' if dirname else ''
+        srcset = ', '.join('{}{} {}w'.format(prefix, name, width) for width, name in entries)
+        return tag[:4] + ' srcset="{}"'.format(srcset) + tag[4:]
+
+    context['body'] = IMG_RE.sub(add_srcset, body)
+
+
+def setup(app):
+    app.connect('env-updated', on_env_updated)
+    app.connect('html-page-context', on_html_page_context)
+
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
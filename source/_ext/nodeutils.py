@@ -0,0 +1,12 @@
+""" Helpers for working with docutils nodes that are shared by the extensions
+in this directory. """
+
+
+def findall(node, cls):
+    """ Returns a list of the nodes of the given class in the tree under the
+    given node, including itself. """
+
+    # Node.traverse() is deprecated since docutils 0.18.
+    if hasattr(node, 'findall'):
+        return list(node.findall(cls))
+    return list(node.traverse(cls))
@@ -0,0 +1,146 @@
+""" Sphinx extension that splits the HTML search index into small shards.
+
+With the full API reference, searchindex.js grows to many megabytes, all of
+which is downloaded and parsed before the first search.  After an HTML build,
+this extension rewrites searchindex.js so that it only contains the document
+names and titles, and moves the search terms and objects into shards under
+_searchindex/.  searchshards.js, which is loaded by _templates/searchbox.html,
+fetches only the shards needed for a query before the regular Sphinx search
+runs.
+
+Sphinx also matches query words anywhere inside terms and object names, so
+every term and object is put in the shard of each substring of
+searchshards_prefix_length characters that it contains, and a query word
+only needs the shard of its first characters.  With the default length of
+2, this keeps all matches that Sphinx itself finds, which only does partial
+matching for words of at least 3 characters; with a greater length, words
+shorter than it only match whole terms. """
+
+import os
+import shutil
+from collections import defaultdict
+
+from sphinx.search import js_index
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+# Name of the directory in the output containing the shards.
+SHARD_DIR = '_searchindex'
+
+
+def shard_key(word, length):
+    """ Returns the file name of the shard for the given word, as used by
+    searchshards.js for a query word. """
+
+    prefix = word[:length].lower()
+    return prefix.encode('utf-8').hex()
+
+
+def shard_keys(word, length):
+    """ Returns the keys of all shards that the given word must be in, so
+    that any query word that it contains finds it. """
+
+    word = word.lower()
+    if len(word) <= length:
+        return {shard_key(word, length)}
+    return {shard_key(word[i:], length) for i in range(len(word) - length + 1)}
+
+
+def index_objects(objects):
+    """ Yields (prefix, name, entry) for the objects of the search index.
+    Since Sphinx 5, every prefix maps to a list of entries that end with the
+    name, before that to a dictionary mapping the name to the entry. """
+
+    for prefix, entries in objects.items():
+        if isinstance(entries, dict):
+            for name, entry in entries.items():
+                yield prefix, name, entry
+        else:
+            for entry in entries:
+                yield prefix, entry[4], entry
+
+
+def split_index(index, length):
+    """ Splits the given search index, returning the trimmed index and a
+    dictionary mapping shard key to shard contents. """
+
+    shards = defaultdict(lambda: {'terms': {}, 'titleterms': {}, 'objects': {}})
+
+    for key in ('terms', 'titleterms'):
+        for term, docs in index.get(key, {}).items():
+            for shard in shard_keys(term, length):
+                shards[shard][key][term] = docs
+
+    # In the shards, the objects are always stored by name, so that the
+    # entries that are in several loaded shards are only added once.
+    objects = index.get('objects', {})
+    for prefix, name, entry in index_objects(objects):
+        fullname = prefix + '.' + name if prefix else name
+        for shard in shard_keys(fullname, length):
+            shards[shard]['objects'].setdefault(prefix, {})[name] = entry
+
+    is_list = any(isinstance(entries, list) for entries in objects.values())
+
+    trimmed = dict(index)
+    trimmed['terms'] = {}
+    trimmed['titleterms'] = {}
+    trimmed['objects'] = {}
+    trimmed['shards'] = {'length': length, 'keys': sorted(shards),
+                         'objects': 'list' if is_list else 'dict'}
+    return trimmed, shards
+
+
+def full_index_path(app):
+    """ Sphinx reads back the previous search index on incremental builds,
+    so an unsplit copy is kept next to the doctrees. """
+
+    name = os.path.basename(os.path.normpath(app.outdir))
+    return os.path.join(app.doctreedir, 'searchindex-full-{}.js'.format(name))
+
+
+def on_builder_inited(app):
+    if app.builder.format != 'html' or not os.path.isfile(full_index_path(app)):
+        return
+
+    index_fn = os.path.join(app.outdir, app.builder.searchindex_filename)
+    if os.path.isfile(index_fn):
+        shutil.copyfile(full_index_path(app), index_fn)
+
+
+def on_build_finished(app, exception):
+    if exception is not None or app.builder.format != 'html':
+        return
+
+    index_fn = os.path.join(app.outdir, app.builder.searchindex_filename)
+    if not os.path.isfile(index_fn):
+        return
+
+    shutil.copyfile(index_fn, full_index_path(app))
+    with open(index_fn, 'r', encoding='utf-8') as f:
+        index = js_index.load(f)
+
+    trimmed, shards = split_index(index, app.config.searchshards_prefix_length)
+
+    shard_dir = os.path.join(app.outdir, SHARD_DIR)
+    if os.path.isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.mkdir(shard_dir)
+
+    for key, shard in shards.items():
+        with open(os.path.join(shard_dir, key + '.js'), 'w', encoding='utf-8') as f:
+            f.write('SearchShards.add(' + js_index.dumps(shard)[len(js_index.PREFIX):])
+
+    with open(index_fn, 'w', encoding='utf-8') as f:
+        js_index.dump(trimmed, f)
+
+    logger.info('searchshards: split %s into %d shards (%d bytes remaining)',
+                app.builder.searchindex_filename, len(shards), os.path.getsize(index_fn))
+
+
+def setup(app):
+    app.add_config_value('searchshards_prefix_length', 2, 'html')
+    app.connect('builder-inited', on_builder_inited)
+    app.connect('build-finished', on_build_finished)
+
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
@@ -0,0 +1,210 @@
+""" Sphinx extension that resolves the :ref: and :py: cross-references
+emitted by convert.py and generate-apidoc.py, including the ones that the
+domains cannot resolve by themselves:
+
+ * references to the labels of pages that redirect to another page, which
+   are looked up in redirects.json, as written by foo.py;
+ * references to the short names of classes and methods (`NodePath.get_pos`),
+   which are expanded to the fully qualified names that are listed in
+   apidoc-inventory.jsonl, as written by generate-apidoc.py.
+
+Everything else is looked up in the std and py domains the same way as they
+do themselves.  When the reference is not part of the build but linked
+through intersphinx, short names are expanded to their full names, which
+intersphinx then resolves.
+
+All references that remain unresolved are written to unresolved.json in the
+doctree directory and summarised at the end of the build. """
+
+import os
+import json
+from collections import Counter, defaultdict
+
+from sphinx import addnodes
+from sphinx.transforms import SphinxTransform
+from sphinx.util import logging
+from sphinx.util.nodes import make_refnode
+
+from nodeutils import findall
+
+# conf.py puts the top of the checkout on the path for this.
+from common import transform_title
+
+logger = logging.getLogger(__name__)
+
+# Built by build_index(); maps the labels of redirecting pages to the label
+# of the page they redirect to.
+redirect_labels = {}
+
+# Maps unambiguous short names of Python objects to their full names.
+py_full_names = {}
+
+# (refdoc, role, target) of every reference that could not be resolved.
+unresolved = set()
+
+# How many unresolved targets to list in the summary.
+SUMMARY_LENGTH = 20
+
+
+def py_object(name, entry):
+    """ Returns (docname, node id, objtype) for the given Python object, for
+    any version of the py domain's data layout. """
+
+    if len(entry) == 2:
+        # Sphinx < 4: (docname, objtype)
+        return entry[0], name, entry[1]
+    else:
+        return entry[0], entry[1], entry[2]
+
+
+def add_redirect_labels(env, config):
+    if not os.path.isfile(config.xrefindex_redirects):
+        return
+
+    labels = env.get_domain('std').data['labels']
+
+    # Make the labels of pages that redirect elsewhere point to the target.
+    redirects = json.load(open(config.xrefindex_redirects, 'r'))
+    for title in redirects:
+        target = title
+        seen = set()
+        while target in redirects and target not in seen:
+            seen.add(target)
+            target = redirects[target].split('#', 1)[0]
+
+        label = transform_title(title)
+        if label not in labels and transform_title(target) in labels:
+            redirect_labels[label] = transform_title(target)
+
+
+def add_python_names(env, config):
+    if not os.path.isfile(config.xrefindex_inventory):
+        return
+
+    # Add short names (without the module) of everything in the inventory,
+    # but only those that are unambiguous.
+    short_names = defaultdict(set)
+    for line in open(config.xrefindex_inventory, 'r'):
+        record = json.loads(line)
+        full_name = record['module'] + '.' + record['name']
+        short_names[record['name']].add(full_name)
+
+        for method in record.get('methods', ()):
+            short_names[record['name'] + '.' + method['name']].add(full_name + '.' + method['name'])
+
+    for short_name, full_names in short_names.items():
+        if len(full_names) == 1 and short_name not in full_names:
+            py_full_names[short_name] = full_names.pop()
+
+
+def build_index(app, env):
+    redirect_labels.clear()
+    py_full_names.clear()
+    unresolved.clear()
+
+    add_redirect_labels(env, app.config)
+    add_python_names(env, app.config)
+
+    logger.info('xrefindex: %d redirected labels, %d short python names',
+                len(redirect_labels), len(py_full_names))
+
+
+class IndexedReferencesResolver(SphinxTransform):
+    """ Resolves the references to redirected pages and short names before
+    the regular ReferencesResolver (priority 10) gets to see them. """
+
+    default_priority = 5
+
+    def apply(self):
+        py_domain = self.env.get_domain('py')
+        std_domain = self.env.get_domain('std')
+        labels = std_domain.data['labels']
+        builder = self.app.builder
+
+        for node in findall(self.document, addnodes.pending_xref):
+            domain = node.get('refdomain')
+            typ = node['reftype']
+            target = node['reftarget']
+            refdoc = node.get('refdoc', self.env.docname)
+            newnode = None
+
+            if domain == 'std' and typ == 'ref':
+                entry = labels.get(target) or labels.get(redirect_labels.get(target))
+                if entry is not None:
+                    docname, labelid, sectname = entry
+                    if node['refexplicit']:
+                        sectname = node.astext()
+                    newnode = std_domain.build_reference_node(refdoc, builder, docname, labelid, sectname, 'ref')
+
+            elif domain == 'py' and not node.get('refspecific'):
+                if target.endswith('()'):
+                    target = target[:-2]
+
+                entry = self.find_python(py_domain, node, target, typ)
+                full_name = py_full_names.get(target)
+                if entry is None and full_name:
+                    entry = self.find_python(py_domain, node, full_name, typ)
+                    if entry is None:
+                        # Leave it to intersphinx, under its full name.
+                        node['reftarget'] = full_name
+
+                if entry is not None:
+                    docname, node_id, objtype = entry
+                    if objtype in py_domain.objtypes_for_role(typ):
+                        newnode = make_refnode(builder, refdoc, docname, node_id, node[0].deepcopy(), target)
+
+            if newnode is not None:
+                node.replace_self(newnode)
+
+    def find_python(self, py_domain, node, target, typ):
+        """ Looks the target up the same way as the py domain does, with the
+        current module and class as context. """
+
+        matches = py_domain.find_obj(self.env, node.get('py:module'), node.get('py:class'), target, typ, 0)
+        if not matches:
+            return None
+
+        name, entry = matches[0]
+        return py_object(name, entry)
+
+
+def on_missing_reference(app, env, node, contnode):
+    target = node['reftarget']
+    role = '{}:{}'.format(node.get('refdomain') or 'std', node['reftype'])
+    unresolved.add((node.get('refdoc', env.docname), role, target))
+
+
+def on_build_finished(app, exception):
+    if exception is not None:
+        return
+
+    by_target = Counter((role, target) for refdoc, role, target in unresolved)
+    report = sorted(unresolved)
+
+    output = os.path.join(app.doctreedir, 'unresolved.json')
+    with open(output, 'w') as f:
+        json.dump([{'doc': refdoc, 'role': role, 'target': target} for refdoc, role, target in report], f, indent=1)
+
+    if not by_target:
+        return
+
+    logger.info('')
+    logger.info('%d unresolved references to %d targets, most common:', len(report), len(by_target))
+    for (role, target), count in by_target.most_common(SUMMARY_LENGTH):
+        logger.info('%5d  :%s:`%s`', count, role, target)
+    logger.info('Full list written to %s', output)
+
+
+def setup(app):
+    confdir = app.confdir
+    app.add_config_value('xrefindex_redirects', os.path.join(confdir, '..', 'redirects.json'), '')
+    app.add_config_value('xrefindex_inventory', os.path.join(confdir, '..', 'apidoc-inventory.jsonl'), '')
+
+    app.add_post_transform(IndexedReferencesResolver)
+    app.connect('env-updated', build_index)
+    # Run after the other handlers, such as intersphinx's, so that only the
+    # references that none of them resolved are recorded.
+    app.connect('missing-reference', on_missing_reference, priority=900)
+    app.connect('build-finished', on_build_finished)
+
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
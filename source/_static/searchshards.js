@@ -0,0 +1,148 @@
+/*
+ * Loads the search index shards written by the searchshards extension.
+ *
+ * searchindex.js only contains the document names and titles; the terms
+ * and objects are split into _searchindex/<key>.js files.  Before a query is
+ * run, the shards for the prefixes of all query words are loaded and merged
+ * into the index, after which the regular Sphinx search takes over.
+ *
+ * This only uses plain JavaScript, since Sphinx no longer ships jQuery and
+ * Underscore since version 6.
+ */
+
+var SearchShards = {
+  loaded : {},
+  waiting : {},
+  added : {},
+
+  /* Returns the shard file name for a word, which is the hex encoding of
+   * the UTF-8 bytes of its prefix. */
+  key : function(word, length) {
+    var bytes = unescape(encodeURIComponent(word.substr(0, length).toLowerCase()));
+    var key = '';
+    for (var i = 0; i < bytes.length; i++) {
+      key += ('0' + bytes.charCodeAt(i).toString(16)).slice(-2);
+    }
+    return key;
+  },
+
+  /* Called by each shard file once it has been loaded. */
+  add : function(shard) {
+    var index = Search._index;
+    var key;
+    for (key in shard.terms) {
+      index.terms[key] = shard.terms[key];
+    }
+    for (key in shard.titleterms) {
+      index.titleterms[key] = shard.titleterms[key];
+    }
+
+    // The same object may be in several shards.  Since Sphinx 5, the objects
+    // of each prefix are a list of entries ending with the name, before that
+    // a mapping of the name to the entry.
+    var asList = index.shards.objects === 'list';
+    for (var prefix in shard.objects) {
+      var entries = index.objects[prefix] || (asList ? [] : {});
+      for (var name in shard.objects[prefix]) {
+        if (!asList) {
+          entries[name] = shard.objects[prefix][name];
+        } else if (!this.added[prefix + '.' + name]) {
+          this.added[prefix + '.' + name] = true;
+          entries.push(shard.objects[prefix][name]);
+        }
+      }
+      index.objects[prefix] = entries;
+    }
+  },
+
+  /* Returns the root URL of the documentation, which Sphinx 7.2 moved from
+   * DOCUMENTATION_OPTIONS to an attribute of the html element. */
+  root : function() {
+    var root = document.documentElement.dataset.content_root;
+    if (root === undefined) {
+      root = DOCUMENTATION_OPTIONS.URL_ROOT;
+    }
+    return root;
+  },
+
+  load : function(key, callback) {
+    if (this.loaded[key]) {
+      callback();
+      return;
+    }
+    if (this.waiting[key]) {
+      this.waiting[key].push(callback);
+      return;
+    }
+    this.waiting[key] = [callback];
+
+    var self = this;
+    var done = function() {
+      var callbacks = self.waiting[key];
+      self.loaded[key] = true;
+      delete self.waiting[key];
+      for (var i = 0; i < callbacks.length; i++) {
+        callbacks[i]();
+      }
+    };
+
+    // A script element also works for pages opened from the filesystem.
+    var script = document.createElement('script');
+    script.src = this.root() + '_searchindex/' + key + '.js';
+    script.onload = done;
+    script.onerror = done;
+    document.getElementsByTagName('head')[0].appendChild(script);
+  },
+
+  /* Loads all shards that may contain words of the given query. */
+  prepare : function(query, callback) {
+    var shards = Search._index.shards;
+    var stemmer = new Stemmer();
+    var words = splitQuery(query);
+    var keys = {};
+
+    for (var i = 0; i < words.length; i++) {
+      var word = words[i].toLowerCase().replace(/^-/, '');
+      if (word === '') {
+        continue;
+      }
+      keys[this.key(word, shards.length)] = true;
+      keys[this.key(stemmer.stemWord(word), shards.length)] = true;
+    }
+
+    var needed = [];
+    for (var key in keys) {
+      if (shards.keys.indexOf(key) != -1) {
+        needed.push(key);
+      }
+    }
+
+    var remaining = needed.length;
+    if (remaining === 0) {
+      callback();
+      return;
+    }
+    for (i = 0; i < needed.length; i++) {
+      this.load(needed[i], function() {
+        if (--remaining === 0) {
+          callback();
+        }
+      });
+    }
+  }
+};
+
+if (typeof Search !== 'undefined') {
+  (function() {
+    var query = Search.query;
+    Search.query = function(q) {
+      var self = this;
+      if (!self._index || !self._index.shards) {
+        return query.call(self, q);
+      }
+      SearchShards.prepare(q, function() {
+        query.call(self, q);
+      });
+    };
+  })();
+}
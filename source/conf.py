@@ -19,6 +19,10 @@ import os
 # add these directories to sys.path here. If the directory is relative to the
 # documentation root, use os.path.abspath to make it absolute, like shown here.
 #sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(0, os.path.abspath('_ext'))
+
+# For common.py, which the extensions share with the conversion scripts.
+sys.path.insert(0, os.path.abspath('..'))
 
 # -- General configuration ------------------------------------------------
 
@@ -28,7 +32,18 @@ import os
 # Add any Sphinx extension module names here, as strings. They can be
 # extensions coming with Sphinx (named 'sphinx.ext.*') or your custom
 # ones.
-extensions = ['sphinx.ext.autodoc', 'variations']
+extensions = ['sphinx.ext.autodoc', 'variations', 'xrefindex', 'searchshards',
+              'imagevariants']
+
+# Set PANDA3D_BUILDPROFILE to write a report of the time spent on each page.
+if os.environ.get('PANDA3D_BUILDPROFILE'):
+    extensions.append('buildprofile')
+
+# build-html.py builds each variation in a separate sphinx-build process, in
+# which case it passes the variation in here and the tag on the command line.
+variation = os.environ.get('PANDA3D_VARIATION')
+if variation:
+    extensions.remove('variations')
 
 # Add any paths that contain templates here, relative to this directory.
 templates_path = ['_templates']
@@ -56,7 +71,8 @@ version = '1.10'
 release = '1.10.3'
 
 # Whether to generate Python or C++ documentation.  TODO: 
-tags.add('python')
+if not variation:
+    tags.add('python')
 
 variations = [('python', 'Python'),
               ('cpp', 'C++')]
@@ -75,6 +91,20 @@ variations = [('python', 'Python'),
 # directories to ignore when looking for source files.
 exclude_patterns = []
 
+# The API reference may be built as a separate project by build-reference.py,
+# in which case PANDA3D_REFERENCE points to its HTML output, relative to the
+# top of the checkout.  source/reference is then not read at all, and links
+# to the reference go through intersphinx, to PANDA3D_REFERENCE_URL.
+reference = os.environ.get('PANDA3D_REFERENCE')
+if reference:
+    reference = os.path.join(os.path.dirname(os.path.abspath('.')), reference)
+    extensions.append('sphinx.ext.intersphinx')
+    exclude_patterns.append('reference')
+    intersphinx_mapping = {
+        'reference': (os.environ.get('PANDA3D_REFERENCE_URL', reference),
+                      os.path.join(reference, 'objects.inv')),
+    }
+
 # The reST default role (used for this markup: `text`) to use for all
 # documents.
 #default_role = None
@@ -140,6 +170,13 @@ html_context = {
         '_static/panda.css',  # override wide tables in RTD theme
     ],
 }
+
+# Normally provided by the variations extension.  Each variation is written
+# to its own subdirectory, so links to the other one need to go up a level.
+if variation:
+    html_context['variations'] = variations
+    html_context['currentvariation'] = (variation, dict(variations)[variation])
+    html_context['variation_prefix'] = '../'
 # Add any extra paths that contain custom files (such as robots.txt or
 # .htaccess) here, relative to this directory. These files are copied
 # directly to the root of the documentation.
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+""" Writes a copy of the source tree for each language, in which the
+`.. only:: python` and `.. only:: cpp` blocks that convert.py generates for
+the language-specific parts of the manual have been resolved already: the
+blocks for the language itself are unindented, the others are removed.
+Building a variation from its own tree (build-html.py --split-sources) then
+only reads the text of that language.
+
+Pages without any language blocks, images and the configuration are linked
+to the original with relative symlinks instead of being copied.  Files are
+only rewritten when their contents change, so that Sphinx only rereads the
+pages that were actually reconverted. """
+
+import os
+import re
+import shutil
+import argparse
+
+# Must match the names that LangSwitch uses in the only directives.
+LANGUAGES = ['python', 'cpp']
+
+SOURCE_DIR = 'source'
+
+ONLY_RE = re.compile(r'^([ \t]*)\.\. only::[ \t]*(\S+)[ \t]*$')
+
+
+def indent_of(line):
+    return len(line) - len(line.lstrip(' \t'))
+
+
+def filter_lines(lines, lang):
+    """ Resolves the only directives for the given language in the list of
+    lines, which each end with a newline. """
+
+    result = []
+    i = 0
+    while i < len(lines):
+        match = ONLY_RE.match(lines[i].rstrip('\n'))
+        if not match or match.group(2) not in LANGUAGES:
+            result.append(lines[i])
+            i += 1
+            continue
+
+        # The content is everything indented further than the directive.
+        indent = len(match.group(1))
+        end = i + 1
+        while end < len(lines) and (not lines[end].strip() or indent_of(lines[end]) > indent):
+            end += 1
+
+        # Leave the blank lines at the end in place, to separate what
+        # comes before from what comes after.
+        content_end = end
+        while content_end > i + 1 and not lines[content_end - 1].strip():
+            content_end -= 1
+
+        if match.group(2) == lang:
+            content = lines[i + 1:content_end]
+            dedent = min(indent_of(line) for line in content if line.strip()) - indent if content else 0
+            content = [line[dedent:] if line.strip() else '\n' for line in content]
+            result.extend(filter_lines(content, lang))
+
+        result.extend(lines[content_end:end])
+        i = end
+
+    return result
+
+
+def filter_text(text, lang):
+    return ''.join(filter_lines(text.splitlines(True), lang))
+
+
+def link(source, target):
+    """ Makes target a relative symlink to source, if it isn't already. """
+
+    rel = os.path.relpath(source, os.path.dirname(target))
+    if os.path.islink(target):
+        if os.readlink(target) == rel:
+            return
+        os.remove(target)
+    elif os.path.isdir(target):
+        shutil.rmtree(target)
+    elif os.path.exists(target):
+        os.remove(target)
+    os.symlink(rel, target)
+
+
+def write(text, target):
+    """ Writes the text to target, unless it already contains it. """
+
+    if os.path.islink(target):
+        os.remove(target)
+    elif os.path.isfile(target):
+        with open(target, 'r', encoding='utf-8') as f:
+            if f.read() == text:
+                return False
+
+    with open(target, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return True
+
+
+def split_tree(source_dir, lang, target_dir):
+    """ Brings target_dir up to date with source_dir for the given language.
+    Returns the number of pages that were filtered and that were linked. """
+
+    num_filtered = 0
+    num_linked = 0
+    seen = set()
+
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        rel_dir = os.path.relpath(dirpath, source_dir)
+        out_dir = os.path.normpath(os.path.join(target_dir, rel_dir))
+        if os.path.islink(out_dir):
+            os.remove(out_dir)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        seen.add(out_dir)
+
+        # Extensions, templates and static files are linked as a whole.
+        for dirname in dirnames[:]:
+            if dirname.startswith(('_', '.')):
+                dirnames.remove(dirname)
+                target = os.path.join(out_dir, dirname)
+                if not dirname.startswith('.'):
+                    link(os.path.join(dirpath, dirname), target)
+                    seen.add(target)
+
+        for fn in filenames:
+            source = os.path.join(dirpath, fn)
+            target = os.path.join(out_dir, fn)
+            seen.add(target)
+
+            if fn.endswith('.rst'):
+                with open(source, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                filtered = filter_text(text, lang)
+                if filtered != text:
+                    write(filtered, target)
+                    num_filtered += 1
+                    continue
+                num_linked += 1
+
+            link(source, target)
+
+    # Remove whatever is no longer in the source tree.
+    for dirpath, dirnames, filenames in os.walk(target_dir, topdown=False):
+        for name in filenames + dirnames:
+            path = os.path.join(dirpath, name)
+            if path in seen:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    return num_filtered, num_linked
+
+
+def tree_path(lang):
+    return '{}-{}'.format(SOURCE_DIR, lang)
+
+
+def split_all(source_dir=SOURCE_DIR):
+    for lang in LANGUAGES:
+        num_filtered, num_linked = split_tree(source_dir, lang, tree_path(lang))
+        print("{}: {} pages filtered, {} linked.".format(tree_path(lang), num_filtered, num_linked))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Writes a source tree for each language, without the blocks for the other.")
+    parser.add_argument('source_dir', nargs='?', default=SOURCE_DIR,
+                        help="the converted manual (default: source)")
+    args = parser.parse_args()
+
+    split_all(args.source_dir)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+""" Watches the dump, the converter scripts, the manual images and the
+converted pages, and keeps build/html up to date while serving it locally,
+for a quick edit-preview loop.
+
+ * When the dump or a converter script changes, foo.py is run with --resume,
+   which only reconverts the pages whose text or converter changed.
+ * When an image in manual-images/ changes, it is copied over the copies
+   that foo.py made of it in source/.
+ * After that, or when a page in source/ was edited by hand, sphinx-build
+   is run, which only rereads the pages that changed.
+
+Changes are found by polling the modification times, so that this works
+the same everywhere without extra dependencies.  Any options that are not
+recognised are passed on to foo.py. """
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import threading
+import subprocess
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+from common import transform_title, CONVERTER_SCRIPTS
+
+IMAGE_DIR = 'manual-images'
+SOURCE_DIR = 'source'
+BUILD_DIR = 'build'
+
+
+def snapshot(paths):
+    """ Returns a dictionary mapping each existing file to its mtime. """
+
+    return {path: os.stat(path).st_mtime_ns for path in paths if os.path.isfile(path)}
+
+
+def files_in(dirname, suffix=''):
+    for dirpath, dirnames, filenames in os.walk(dirname):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for fn in filenames:
+            if fn.endswith(suffix):
+                yield os.path.join(dirpath, fn)
+
+
+def changed(old, new):
+    """ Returns the files that were added, modified or removed. """
+
+    return {path for path in set(old) | set(new) if old.get(path) != new.get(path)}
+
+
+class Watcher(object):
+    def __init__(self, dump, foo_args, sphinx_opts):
+        self.dump = dump
+        self.foo_args = foo_args
+        self.sphinx_opts = sphinx_opts
+        self.inputs = self.scan_inputs()
+        self.images = self.scan_images()
+        self.pages = self.scan_pages()
+
+    def scan_inputs(self):
+        return snapshot([self.dump] + CONVERTER_SCRIPTS)
+
+    def scan_images(self):
+        return snapshot(files_in(IMAGE_DIR))
+
+    def scan_pages(self):
+        return snapshot(files_in(SOURCE_DIR, '.rst'))
+
+    def convert(self):
+        print("Reconverting changed pages...")
+        cmd = [sys.executable, 'foo.py', self.dump, '--resume'] + self.foo_args
+        return subprocess.call(cmd) == 0
+
+    def copy_images(self, paths):
+        """ Copies the changed images to wherever foo.py put them. """
+
+        names = {transform_title(os.path.basename(path)): path for path in paths if os.path.isfile(path)}
+        for target in files_in(SOURCE_DIR):
+            source = names.get(os.path.basename(target))
+            if source:
+                print("Updating {}".format(target))
+                shutil.copyfile(source, target)
+
+    def build(self):
+        cmd = [os.environ.get('SPHINXBUILD', 'sphinx-build'),
+               '-b', 'html',
+               '-d', os.path.join(BUILD_DIR, 'doctrees')]
+        cmd += self.sphinx_opts
+        cmd += [SOURCE_DIR, os.path.join(BUILD_DIR, 'html')]
+
+        start = time.time()
+        if subprocess.call(cmd) == 0:
+            print("Rebuilt in {:.1f} s.".format(time.time() - start))
+
+    def poll(self):
+        """ Checks for changes and acts on them.  Returns True if anything
+        was rebuilt. """
+
+        inputs = self.scan_inputs()
+        images = self.scan_images()
+        pages = self.scan_pages()
+
+        changed_inputs = changed(self.inputs, inputs)
+        changed_images = changed(self.images, images)
+        changed_pages = changed(self.pages, pages)
+        if not (changed_inputs or changed_images or changed_pages):
+            return False
+
+        for path in sorted(changed_inputs | changed_images | changed_pages):
+            print("Changed: {}".format(path))
+
+        self.inputs = inputs
+        self.images = images
+
+        if changed_inputs:
+            self.convert()
+        if changed_images:
+            self.copy_images(changed_images)
+
+        # The pages that were reconverted don't need to be seen again.
+        self.pages = self.scan_pages()
+        self.build()
+        return True
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            if self.poll():
+                print("Watching for changes...")
+
+
+def serve(port):
+    """ Serves the HTML output in a background thread. """
+
+    handler = partial(SimpleHTTPRequestHandler, directory=os.path.join(BUILD_DIR, 'html'))
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuilds the manual when its sources change, and serves it locally.")
+    parser.add_argument('dump', nargs='?', default='dump.xml',
+                        help="the MediaWiki XML export to watch (default: dump.xml)")
+    parser.add_argument('-p', '--port', type=int, default=8000,
+                        help="port to serve build/html on (default: 8000), or 0 to not serve it")
+    parser.add_argument('-i', '--interval', type=float, default=1.0,
+                        help="seconds between checks for changes (default: 1)")
+    parser.add_argument('-O', '--sphinx-opt', action='append', dest='sphinx_opts', default=[],
+                        help="option to pass on to sphinx-build (may be repeated)")
+
+    # Any other options are passed on to foo.py.
+    args, foo_args = parser.parse_known_args()
+
+    watcher = Watcher(args.dump, foo_args, args.sphinx_opts)
+
+    # Bring everything up to date first.
+    if os.path.isfile(args.dump):
+        watcher.convert()
+        watcher.pages = watcher.scan_pages()
+    watcher.build()
+
+    if args.port:
+        serve(args.port)
+        print("Serving {}/html at http://127.0.0.1:{}/".format(BUILD_DIR, args.port))
+
+    print("Watching for changes...")
+    try:
+        watcher.run(args.interval)
+    except KeyboardInterrupt:
+        pass
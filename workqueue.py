@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+""" A work queue in a shared directory, with which foo.py --queue spreads the
+conversion of pages over worker processes on any number of hosts that can
+see the directory and the checkout, which they need to run convert.py.
+
+The queue consists of these subdirectories:
+
+ * pending/ holds a JSON file per job that nobody is working on.  Jobs are
+   claimed in the order of their names.
+ * active/ holds the jobs that have been claimed.  A worker claims a job by
+   renaming it from pending/ to active/, which only one worker can do, and
+   then keeps a <job>.lease file next to it up to date while converting.
+ * done/ holds the result of every finished job.
+
+Jobs whose lease has not been renewed for --lease seconds, because their
+worker died or lost its connection, are put back into pending/ by the
+coordinator.  Workers write the converted page to a temporary file that is
+renamed into place, so a page is never left half-written, even if two
+workers end up converting the same page.  A worker stops when the
+coordinator has created the file named closed.
+
+Start a worker in the root of the checkout with:
+
+    python3 workqueue.py /shared/queue -j 4
+"""
+
+import os
+import json
+import time
+import socket
+import shutil
+import argparse
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from common import convert_page
+
+# Seconds after which a job whose lease was not renewed is requeued.
+LEASE_SECONDS = 120
+
+# Seconds to wait before looking at the queue again when it is empty.
+POLL_INTERVAL = 0.5
+
+
+class WorkQueue(object):
+    def __init__(self, path):
+        self.path = path
+        self.pending = os.path.join(path, 'pending')
+        self.active = os.path.join(path, 'active')
+        self.done = os.path.join(path, 'done')
+        self.tmp = os.path.join(path, 'tmp')
+
+    def create(self):
+        """ Sets up an empty queue, removing any jobs of an earlier run.
+        Returns an id for this run, to be used in the names of its jobs, so
+        that a worker still busy with a job of an earlier run cannot pass its
+        result off as that of a job of this one. """
+
+        for dirname in (self.pending, self.active, self.done, self.tmp):
+            if os.path.isdir(dirname):
+                shutil.rmtree(dirname)
+            os.makedirs(dirname)
+
+        if os.path.exists(self.closed_path()):
+            os.remove(self.closed_path())
+
+        return uuid.uuid4().hex[:8]
+
+    def closed_path(self):
+        return os.path.join(self.path, 'closed')
+
+    def close(self):
+        """ Tells the workers to stop. """
+
+        open(self.closed_path(), 'w').close()
+
+    def is_closed(self):
+        return os.path.exists(self.closed_path())
+
+    def write_json(self, path, data):
+        """ Writes the file so that it appears all at once. """
+
+        tmp = os.path.join(self.tmp, '{}-{}-{}'.format(socket.gethostname(), os.getpid(), threading.get_ident()))
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def put(self, name, job):
+        self.write_json(os.path.join(self.pending, name + '.json'), job)
+
+    def claim(self, worker):
+        """ Returns the name and the contents of the first pending job, which
+        is now leased to the given worker, or None if there are none. """
+
+        try:
+            names = sorted(os.listdir(self.pending))
+        except FileNotFoundError:
+            return None
+
+        for fn in names:
+            if not fn.endswith('.json'):
+                continue
+
+            name = fn[:-5]
+            try:
+                os.rename(os.path.join(self.pending, fn), os.path.join(self.active, fn))
+            except FileNotFoundError:
+                # Claimed by someone else first.
+                continue
+
+            self.write_lease(name, worker)
+            with open(os.path.join(self.active, fn), 'r', encoding='utf-8') as f:
+                return name, json.load(f)
+
+        return None
+
+    def lease_path(self, name):
+        return os.path.join(self.active, name + '.lease')
+
+    def write_lease(self, name, worker):
+        tmp = os.path.join(self.tmp, '{}-{}-{}'.format(socket.gethostname(), os.getpid(), threading.get_ident()))
+        with open(tmp, 'w') as f:
+            f.write(worker)
+        os.replace(tmp, self.lease_path(name))
+
+    def lease_owner(self, name):
+        """ Returns the worker holding the lease of the job, or None if the
+        job is not leased. """
+
+        try:
+            with open(self.lease_path(name), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def renew(self, name, worker):
+        """ Extends the lease of the job.  Returns False if the job is no
+        longer leased to the given worker, because it was requeued. """
+
+        if self.lease_owner(name) != worker:
+            return False
+
+        try:
+            os.utime(self.lease_path(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, name, worker, result):
+        """ Stores the result of the job and gives up the lease. """
+
+        self.write_json(os.path.join(self.done, name + '.json'), result)
+
+        # If the job was requeued in the meantime, the files in active/
+        # belong to whoever claimed it next, or are gone already.
+        if self.lease_owner(name) != worker:
+            return
+
+        for fn in (name + '.json', name + '.lease'):
+            try:
+                os.remove(os.path.join(self.active, fn))
+            except FileNotFoundError:
+                pass
+
+    def results(self):
+        """ Returns the names of the finished jobs. """
+
+        return [fn[:-5] for fn in os.listdir(self.done) if fn.endswith('.json')]
+
+    def result(self, name):
+        with open(os.path.join(self.done, name + '.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def requeue_expired(self, lease_seconds=LEASE_SECONDS):
+        """ Moves the jobs whose lease has run out back to pending/.  Returns
+        the names of these jobs. """
+
+        now = time.time()
+        requeued = []
+        for fn in os.listdir(self.active):
+            if not fn.endswith('.json'):
+                continue
+
+            name = fn[:-5]
+            try:
+                # The rename into active/ counts as the start of the lease.
+                last = os.stat(os.path.join(self.active, fn)).st_ctime
+                lease = self.lease_path(name)
+                if os.path.exists(lease):
+                    last = max(last, os.stat(lease).st_mtime)
+
+                if now - last > lease_seconds:
+                    # Remove the lease first, so that it cannot be taken for
+                    # the lease of the worker that claims the job next.
+                    if os.path.exists(lease):
+                        os.remove(lease)
+                    os.rename(os.path.join(self.active, fn), os.path.join(self.pending, fn))
+                    requeued.append(name)
+            except FileNotFoundError:
+                # Finished while we were looking at it.
+                continue
+
+        return requeued
+
+
+def run_job(queue, worker, name, job, lease_seconds):
+    """ Converts the page of the given job, renewing the lease meanwhile. """
+
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(lease_seconds / 4):
+            if not queue.renew(name, worker):
+                return
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    start = time.perf_counter()
+    tmp = '{}.{}-{}.tmp'.format(job['output'], socket.gethostname(), threading.get_ident())
+    try:
+        parent = os.path.dirname(job['output'])
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent, exist_ok=True)
+
+        failed, seconds = convert_page(job['title'], job['text'], tmp, job['children'])
+        os.replace(tmp, job['output'])
+    except OSError as ex:
+        # Report the page as failed rather than letting the job expire, or
+        # it would be requeued and fail again forever.
+        print("{} {}: {}".format(worker, job['path'], ex))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        failed, seconds = True, time.perf_counter() - start
+    finally:
+        stop.set()
+        thread.join()
+
+    queue.complete(name, worker, {'path': job['path'], 'hash': job['hash'], 'output': job['output'],
+                          'failed': failed, 'seconds': seconds, 'worker': worker})
+    return failed
+
+
+def work(queue, worker, lease_seconds=LEASE_SECONDS):
+    """ Converts pages from the queue until it is closed.  Returns the number
+    of pages that were converted. """
+
+    count = 0
+    while True:
+        claimed = queue.claim(worker)
+        if claimed is None:
+            if queue.is_closed():
+                return count
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        name, job = claimed
+        failed = run_job(queue, worker, name, job, lease_seconds)
+        print("{} {}{}".format(worker, job['path'], " (failed)" if failed else ""))
+        count += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Converts pages from a queue created by foo.py --queue.")
+    parser.add_argument('queue', help="the queue directory")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="number of pages to convert at the same time (default: number of CPUs)")
+    parser.add_argument('--lease', type=float, default=LEASE_SECONDS,
+                        help="seconds after which the coordinator gives away a job of an unresponsive worker")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue)
+    name = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        counts = list(executor.map(lambda i: work(queue, '{}/{}'.format(name, i), args.lease), range(args.jobs)))
+
+    print("{} converted {} pages.".format(name, sum(counts)))